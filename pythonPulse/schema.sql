@@ -36,6 +36,28 @@ create table if not exists profiles (
 
 alter table profiles enable row level security;
 
+-- When a Discord account was (re)linked. Presence sync's known-users refresh polls this
+-- rather than updated_at, which presence status writes would bump constantly
+alter table profiles add column if not exists discord_user_id text;
+alter table profiles add column if not exists discord_linked_at timestamp with time zone;
+create index if not exists profiles_discord_linked_at_idx on profiles (discord_linked_at);
+
+create or replace function public.set_discord_linked_at()
+returns trigger as $$
+begin
+  if tg_op = 'INSERT' or new.discord_user_id is distinct from old.discord_user_id then
+    new.discord_linked_at = timezone('utc'::text, now());
+  end if;
+  return new;
+end;
+$$ language plpgsql;
+
+drop trigger if exists set_profiles_updated_at on profiles;
+drop trigger if exists set_profiles_discord_linked_at on profiles;
+create trigger set_profiles_discord_linked_at
+  before insert or update of discord_user_id on profiles
+  for each row execute procedure public.set_discord_linked_at();
+
 -- 5. Create Tickets Table
 create table if not exists tickets (
   id bigint generated by default as identity primary key,
@@ -52,6 +74,16 @@ create table if not exists tickets (
 
 alter table tickets enable row level security;
 
+-- Repeat reports of the same issue are attached to the open ticket instead of opening new ones
+alter table tickets add column if not exists report_count int default 1 not null;
+
+create or replace function increment_ticket_report_count(p_ticket_id bigint)
+returns int
+language sql
+as $$
+  update tickets set report_count = report_count + 1 where id = p_ticket_id returning report_count;
+$$;
+
 -- 6. RLS Policies
 drop policy if exists "Users can view their own tickets" on tickets;
 create policy "Users can view their own tickets" 
@@ -88,3 +120,107 @@ create trigger on_auth_user_created
   after insert on auth.users
   for each row execute procedure public.handle_new_user();
 
+
+-- 8. Stripe Event Cursor (last processed webhook event, used for startup catch-up)
+create table if not exists stripe_event_cursor (
+  id text primary key,
+  event_id text,
+  event_created bigint not null,
+  updated_at timestamp with time zone default timezone('utc'::text, now()) not null
+);
+
+alter table stripe_event_cursor enable row level security;
+
+-- Stripe events handled by the live webhook; catch-up skips these (rows behind the cursor are pruned)
+create table if not exists stripe_processed_events (
+  event_id text primary key,
+  event_created bigint not null,
+  processed_at timestamp with time zone default timezone('utc'::text, now()) not null
+);
+
+create index if not exists stripe_processed_events_created_idx on stripe_processed_events (event_created);
+
+alter table stripe_processed_events enable row level security;
+
+-- 9. Guild Settings (per-Discord-server bot configuration)
+create table if not exists guild_settings (
+  guild_id text primary key,
+  presence_tracking boolean default false not null, -- opt-in presence status sync
+  timezone text, -- IANA name (e.g. 'Europe/London') for the Daily Pulse; null = DAILY_PULSE_TIMEZONE
+  summary_hour smallint check (summary_hour between 0 and 23), -- local hour of the Daily Pulse; null = DAILY_PULSE_HOUR
+  created_at timestamp with time zone default timezone('utc'::text, now()) not null,
+  updated_at timestamp with time zone default timezone('utc'::text, now()) not null
+);
+
+alter table guild_settings enable row level security;
+
+-- 10. Cache Invalidations (cross-process cache bus between API workers and bot processes)
+create table if not exists cache_invalidations (
+  id bigint generated by default as identity primary key,
+  topic text not null,
+  key text,
+  origin text,
+  created_at timestamp with time zone default timezone('utc'::text, now()) not null
+);
+
+alter table cache_invalidations enable row level security;
+
+-- Settings edited from the dashboard (or SQL) reach the bot processes through the cache bus
+create or replace function public.publish_guild_settings_change()
+returns trigger as $$
+begin
+  insert into public.cache_invalidations (topic, key, origin)
+  values ('guild_settings', coalesce(new.guild_id, old.guild_id), 'database');
+  return null;
+end;
+$$ language plpgsql;
+
+drop trigger if exists on_guild_settings_changed on guild_settings;
+create trigger on_guild_settings_changed
+  after insert or update or delete on guild_settings
+  for each row execute procedure public.publish_guild_settings_change();
+
+-- 11. Message Claims (one bot instance triages each Discord message)
+create table if not exists message_claims (
+  message_id text primary key, -- "<kind>:<discord message id>"
+  instance_id text,
+  claimed_at timestamp with time zone default timezone('utc'::text, now()) not null
+);
+
+create index if not exists message_claims_claimed_at_idx on message_claims (claimed_at);
+
+alter table message_claims enable row level security;
+
+-- 12. Leases (leader election for scheduled jobs across instances)
+create table if not exists leases (
+  name text primary key,
+  holder text not null,
+  expires_at timestamp with time zone not null
+);
+
+alter table leases enable row level security;
+
+-- 13. Invite Results (bulk invite delivery status, readable from every API worker)
+create table if not exists invite_results (
+  batch_id text not null,
+  email text not null,
+  position integer,
+  status text not null, -- queued | sent | failed: <error>
+  created_at timestamp with time zone default timezone('utc'::text, now()) not null,
+  primary key (batch_id, email)
+);
+
+alter table invite_results enable row level security;
+
+-- 14. Report Sessions (reports waiting for the user's follow-up DM, shared across bot processes)
+create table if not exists report_sessions (
+  discord_user_id text primary key,
+  ticket_id text,
+  guild_id text,
+  channel_id text,
+  content text,
+  score smallint,
+  created_at timestamp with time zone default timezone('utc'::text, now()) not null
+);
+
+alter table report_sessions enable row level security;
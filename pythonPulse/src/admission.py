@@ -0,0 +1,222 @@
+import math
+import time
+import asyncio
+import json
+
+from starlette.datastructures import Headers
+
+
+class RoutePolicy:
+    """
+    Admission limits for one endpoint.
+    - max_concurrent: requests handled at once
+    - max_queue: requests allowed to wait for a slot (beyond that: 503)
+    - queue_timeout: seconds a queued request waits before giving up (503)
+    - rate / burst: per-client token bucket, requests per second and bucket size (beyond that: 429)
+    """
+
+    def __init__(self, max_concurrent=None, max_queue=0, queue_timeout=5.0, rate=None, burst=None):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.rate = rate
+        self.burst = burst or (math.ceil(rate) if rate else None)
+
+    def merged(self, **overrides):
+        """A copy with some settings replaced, the rest kept from this policy."""
+        params = {
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "queue_timeout": self.queue_timeout,
+            "rate": self.rate,
+            "burst": self.burst,
+        }
+        params.update(overrides)
+        return RoutePolicy(**params)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Takes a token. Returns 0 on success, else the seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RouteGate:
+    """Concurrency slots plus a bounded wait queue for one route."""
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.semaphore = asyncio.Semaphore(policy.max_concurrent) if policy.max_concurrent else None
+        self.active = 0
+        self.waiting = 0
+
+
+class AdmissionControlMiddleware:
+    """
+    ASGI middleware shedding load before it reaches the handlers, so a flood on one
+    endpoint can't starve the event loop the Discord bot shares with the API.
+
+    429 (rate limited) and 503 (queue full / queue timeout) both carry Retry-After.
+    Routes are matched on "METHOD /path"; anything without a policy falls back to `default`.
+    trusted_hops is the number of proxies in front of the app that append to X-Forwarded-For
+    (0 = don't trust the header and use the socket peer).
+    """
+
+    # Don't let the per-client bucket map grow without bound
+    MAX_TRACKED_CLIENTS = 10000
+
+    def __init__(self, app, policies=None, default=None, trusted_hops=1):
+        self.app = app
+        self.trusted_hops = trusted_hops
+        self.policies = policies or {}
+        self.default = default
+        self.gates = {}
+        self.buckets = {}
+
+    def _policy_for(self, scope):
+        key = f"{scope['method']} {scope['path']}"
+        if key in self.policies:
+            return key, self.policies[key]
+        if self.default:
+            return "*", self.default
+        return None, None
+
+    def _client_ids(self, scope):
+        """
+        Rate-limit identities for a request: always the IP, plus the user when the caller
+        sends X-User-Id. Both buckets must have a token, so rotating user IDs doesn't get
+        around the per-IP limit.
+
+        The IP is the X-Forwarded-For hop our own proxy appended (trusted_hops from the right):
+        everything left of it is whatever the client sent and can be rotated freely.
+        """
+        headers = Headers(scope=scope)
+        hops = [hop.strip() for hop in headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+        if hops and self.trusted_hops > 0:
+            ip = hops[max(0, len(hops) - self.trusted_hops)]
+        else:
+            client = scope.get("client")
+            ip = client[0] if client else "unknown"
+        ids = [f"ip:{ip}"]
+        user_id = headers.get("x-user-id")
+        if user_id:
+            ids.append(f"user:{user_id}")
+        return ids
+
+    def _bucket(self, key, policy):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.MAX_TRACKED_CLIENTS:
+                # Drop buckets that have refilled completely, they carry no state
+                now = time.monotonic()
+                for k in [k for k, b in self.buckets.items() if b.tokens + (now - b.updated) * b.rate >= b.capacity]:
+                    del self.buckets[k]
+            bucket = self.buckets[key] = TokenBucket(policy.rate, policy.burst)
+        return bucket
+
+    def _check_rate(self, route_key, policy, scope):
+        """Returns 0 if admitted, else seconds until the caller may retry."""
+        if not policy.rate:
+            return 0
+        return max(self._bucket((route_key, client_id), policy).take() for client_id in self._client_ids(scope))
+
+    async def _reject(self, send, status, retry_after, detail):
+        body = json.dumps({"detail": detail}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+
+        route_key, policy = self._policy_for(scope)
+        if not policy:
+            await self.app(scope, receive, send)
+            return
+
+        wait = self._check_rate(route_key, policy, scope)
+        if wait:
+            print(f"ADMISSION: 429 for {route_key} ({', '.join(self._client_ids(scope))})", flush=True)
+            await self._reject(send, 429, wait, "Too many requests, please slow down.")
+            return
+
+        gate = self.gates.get(route_key)
+        if gate is None:
+            gate = self.gates[route_key] = RouteGate(policy)
+
+        if not gate.semaphore:
+            await self.app(scope, receive, send)
+            return
+
+        if not gate.semaphore.locked():
+            # Free slot: acquire() returns without suspending, so the count is exact
+            await gate.semaphore.acquire()
+        elif gate.waiting >= policy.max_queue:
+            print(f"ADMISSION: 503 for {route_key} (queue full: {gate.waiting} waiting)", flush=True)
+            await self._reject(send, 503, policy.queue_timeout, "Server busy, please retry shortly.")
+            return
+        else:
+            gate.waiting += 1
+            try:
+                await asyncio.wait_for(gate.semaphore.acquire(), timeout=policy.queue_timeout)
+            except asyncio.TimeoutError:
+                print(f"ADMISSION: 503 for {route_key} (waited {policy.queue_timeout}s)", flush=True)
+                await self._reject(send, 503, policy.queue_timeout, "Server busy, please retry shortly.")
+                return
+            finally:
+                gate.waiting -= 1
+
+        gate.active += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            gate.active -= 1
+            gate.semaphore.release()
+
+    def stats(self):
+        return {key: {"active": g.active, "waiting": g.waiting} for key, g in self.gates.items()}
+
+
+def load_policies(defaults, env_value):
+    """
+    Applies overrides from an env var (JSON) on top of the default policies, e.g.
+    ADMISSION_POLICIES='{"POST /send-invite": {"max_concurrent": 2, "rate": 0.2}}'
+    Settings an override leaves out keep the route's default; null disables the route's policy.
+    """
+    policies = dict(defaults)
+    if not env_value:
+        return policies
+    try:
+        overrides = json.loads(env_value)
+    except ValueError as e:
+        print(f"Warning: Ignoring invalid ADMISSION_POLICIES: {e}", flush=True)
+        return policies
+    for key, params in overrides.items():
+        if not params:
+            policies[key] = None
+        elif policies.get(key):
+            policies[key] = policies[key].merged(**params)
+        else:
+            policies[key] = RoutePolicy(**params)
+    return {k: v for k, v in policies.items() if v}
@@ -4,13 +4,64 @@ from fastapi.middleware.cors import CORSMiddleware
 import stripe
 import os
 import time
+import asyncio
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from dotenv import load_dotenv
+from subscription_reconciler import reconcile_subscriptions, subscription_priority, derive_profile_state
+from stripe_event_cursor import catch_up_missed_events, record_processed_event
+from singleflight import SingleFlight
+from http_cache import CatalogCache, JSONCompressionMiddleware, conditional_response
+from admission import AdmissionControlMiddleware, RoutePolicy, load_policies
+from services import mail_service
+from services.cache_bus import cache_bus
+from services.leases import LeaderLease
 
 # Load environment variables explicitly
 load_dotenv()
 stripe.api_key = os.getenv("STRIPE_KEY")
 app = FastAPI()
 
+# Bulk Stripe -> profiles reconciliation (0 disables the schedule; the CLI still works)
+RECONCILE_INTERVAL_MINUTES = int(os.getenv("RECONCILE_INTERVAL_MINUTES", 60))
+scheduler = AsyncIOScheduler()
+
+# Shares in-flight Stripe/Supabase calls between concurrent identical requests
+singleflight = SingleFlight()
+
+# GET /products freshness (browser/CDN max-age and how long a stale copy may be served while refreshing)
+PRODUCTS_CACHE_SECONDS = int(os.getenv("PRODUCTS_CACHE_SECONDS", 60))
+PRODUCTS_STALE_SECONDS = int(os.getenv("PRODUCTS_STALE_SECONDS", 300))
+
+# Event types handle_stripe_event acts on (also the filter for the startup catch-up)
+HANDLED_STRIPE_EVENTS = [
+    'checkout.session.completed',
+    'customer.subscription.updated',
+    'customer.subscription.deleted',
+]
+
+# Admission control: per-route concurrency, bounded wait queues and per-IP/per-user token buckets.
+# Overridable per endpoint via ADMISSION_POLICIES (JSON), see admission.load_policies.
+ADMISSION_POLICIES = load_policies({
+    "GET /products": RoutePolicy(max_concurrent=16, max_queue=64, rate=5, burst=20),
+    "POST /create-checkout-session": RoutePolicy(max_concurrent=8, max_queue=16, rate=1, burst=5),
+    "POST /create-portal-session": RoutePolicy(max_concurrent=4, max_queue=8, rate=0.5, burst=3),
+    "POST /cancel-subscription": RoutePolicy(max_concurrent=4, max_queue=8, rate=0.2, burst=3),
+    "POST /sync-subscription": RoutePolicy(max_concurrent=8, max_queue=32, rate=1, burst=5),
+    "POST /send-invite": RoutePolicy(max_concurrent=8, max_queue=16, rate=0.5, burst=5),
+    "POST /send-invites": RoutePolicy(max_concurrent=2, max_queue=4, rate=0.1, burst=2),
+    # Stripe retries failed deliveries, so queue generously and never rate-limit by IP
+    "POST /webhook": RoutePolicy(max_concurrent=8, max_queue=100, queue_timeout=20),
+}, os.getenv("ADMISSION_POLICIES"))
+
+# Added before CORS so 429/503 responses still get CORS headers
+app.add_middleware(
+    AdmissionControlMiddleware,
+    policies=ADMISSION_POLICIES,
+    default=RoutePolicy(max_concurrent=32, max_queue=64, rate=10, burst=30),
+    # Render's proxy appends the client IP as the last X-Forwarded-For hop
+    trusted_hops=int(os.getenv("TRUSTED_PROXY_HOPS", 1))
+)
+
 # Enable CORS for the frontend
 app.add_middleware(
     CORSMiddleware,
@@ -20,30 +71,148 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# gzip/brotli for JSON responses
+app.add_middleware(JSONCompressionMiddleware, minimum_size=500)
+
+# With several API workers/instances, only the lease holder runs the Stripe catch-up and reconciliation
+reconcile_lease = LeaderLease("subscription-reconcile")
+
+async def run_subscription_reconciliation():
+    if not reconcile_lease.is_leader:
+        return
+    # Also moves the Stripe event cursor forward while the service stays up
+    await run_stripe_catch_up()
+    try:
+        # Stripe/Supabase clients are blocking, keep them off the event loop
+        await asyncio.to_thread(reconcile_subscriptions)
+    except Exception as e:
+        print(f"RECONCILE ERROR: {e}", flush=True)
+
+async def run_stripe_catch_up():
+    """Replays Stripe events the webhook missed (downtime, failed deliveries), through the same handler as /webhook."""
+    url = os.getenv("SUPABASE_URL")
+    key = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or os.getenv("SUPABASE_KEY")
+    if not (url and key and os.getenv("STRIPE_KEY")):
+        return
+    try:
+        # Every worker starts at once; one replay is enough
+        if not await asyncio.to_thread(reconcile_lease.try_acquire):
+            print("STRIPE CATCH-UP: another instance holds the lease, skipping", flush=True)
+            return
+        from supabase import create_client
+        supabase = create_client(url, key)
+        await asyncio.to_thread(catch_up_missed_events, supabase, handle_stripe_event, HANDLED_STRIPE_EVENTS)
+    except Exception as e:
+        print(f"STRIPE CATCH-UP ERROR: {e}", flush=True)
+
+@app.on_event("startup")
+async def start_background_jobs():
+    # Don't hold up startup on Stripe paging
+    asyncio.create_task(run_stripe_catch_up())
+
+    # Catalog changes seen by another worker/process drop this worker's copy too
+    cache_bus.subscribe("products", lambda key: product_catalog.invalidate())
+    cache_bus.start()
+
+    if os.getenv("STRIPE_KEY"):
+        # Keeps the lease renewed while a long catch-up runs, and for the reconciliation
+        reconcile_lease.start()
+
+    if RECONCILE_INTERVAL_MINUTES > 0 and os.getenv("STRIPE_KEY"):
+        print(f"Scheduling subscription reconciliation every {RECONCILE_INTERVAL_MINUTES} minutes", flush=True)
+        scheduler.add_job(
+            run_subscription_reconciliation, 'interval',
+            minutes=RECONCILE_INTERVAL_MINUTES,
+            id='subscription-reconcile', max_instances=1, coalesce=True
+        )
+        scheduler.start()
+
+def fetch_products():
+    """Active Stripe products with their default price, cheapest first."""
+    # Fetch active products from Stripe
+    products = stripe.Product.list(active=True)
+    results = []
+    for product in products.data:
+        # Fetch the default price for the product
+        prices = stripe.Price.list(product=product.id, active=True, limit=1)
+        price = prices.data[0] if prices.data else None
+        
+        results.append({
+            "id": product.id,
+            "name": product.name,
+            "description": product.description,
+            "price_id": price.id if price else None,
+            "price": price.unit_amount / 100 if price else 0,
+            "currency": price.currency if price else "gbp",
+            "metadata": product.metadata
+        })
+    return sorted(results, key=lambda x: x['price'])
+
+product_catalog = CatalogCache(fetch_products, ttl_seconds=PRODUCTS_CACHE_SECONDS, stale_seconds=PRODUCTS_STALE_SECONDS)
+
+async def refresh_product_catalog():
+    try:
+        await singleflight.do("products", product_catalog.refresh)
+    except Exception as e:
+        print(f"Warning: Product catalog refresh failed: {e}", flush=True)
+
 @app.get("/products")
-async def get_products():
+async def get_products(request: Request):
     try:
-        # Fetch active products from Stripe
-        products = stripe.Product.list(active=True)
-        results = []
-        for product in products.data:
-            # Fetch the default price for the product
-            prices = stripe.Price.list(product=product.id, active=True, limit=1)
-            price = prices.data[0] if prices.data else None
-            
-            results.append({
-                "id": product.id,
-                "name": product.name,
-                "description": product.description,
-                "price_id": price.id if price else None,
-                "price": price.unit_amount / 100 if price else 0,
-                "currency": price.currency if price else "gbp",
-                "metadata": product.metadata
-            })
-        return sorted(results, key=lambda x: x['price'])
+        entry, state = product_catalog.get()
+        if state == "missing":
+            # Concurrent page loads share a single Stripe round trip
+            entry = await singleflight.do("products", product_catalog.refresh)
+        elif state == "stale" and not singleflight.in_flight("products"):
+            # Serve the stale copy now and refresh behind it
+            asyncio.create_task(refresh_product_catalog())
+        return conditional_response(request, entry, PRODUCTS_CACHE_SECONDS, PRODUCTS_STALE_SECONDS)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def find_subscription_history(email):
+    """Returns (has_prior_subscription, active_sub) across ALL customers sharing this email."""
+    # Search ALL customers with this email to avoid duplicates hiding history
+    customers = stripe.Customer.list(email=email, limit=100)
+    
+    has_prior_subscription = False
+    active_sub = None
+
+    for customer in customers.data:
+        # Check for any subscriptions (active, canceled, past due, etc.)
+        subscriptions = stripe.Subscription.list(customer=customer.id, status='all', limit=100)
+        for sub in subscriptions.data:
+            # If user has an ACTIVE or TRIALING subscription right now
+            if sub.status in ['active', 'trialing']:
+                active_sub = sub
+            
+            # Check for ANY history
+            if sub.status in ['active', 'trialing', 'canceled', 'past_due', 'unpaid', 'incomplete_expired']:
+                 has_prior_subscription = True
+                 print(f"DEBUG: Found prior sub {sub.id} (status={sub.status}) for customer {customer.id}")
+        
+        if has_prior_subscription: 
+            break
+
+    return has_prior_subscription, active_sub
+
+def find_stripe_customer_id(user_id):
+    """Blocking: the profile's stored Stripe customer ID, or None (also when the lookup fails)."""
+    try:
+        from supabase import create_client
+        supabase_url = os.getenv("SUPABASE_URL")
+        supabase_key = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or os.getenv("SUPABASE_KEY")
+        supabase_client = create_client(supabase_url, supabase_key)
+        
+        profile_res = supabase_client.table('profiles').select('stripe_customer_id').eq('id', user_id).single().execute()
+        if profile_res.data:
+            stripe_customer_id = profile_res.data.get('stripe_customer_id')
+            print(f"DEBUG CHECKOUT: Found existing stripe_customer_id: {stripe_customer_id}")
+            return stripe_customer_id
+    except Exception as e:
+        print(f"DEBUG CHECKOUT: Error fetching customer_id from DB: {e}")
+    return None
+
 @app.post("/create-checkout-session")
 async def create_checkout_session(data: dict):
     try:
@@ -52,23 +221,12 @@ async def create_checkout_session(data: dict):
         customer_email = data.get("email")
         user_id = data.get("user_id")
         
-        # 1. Try to find the existing Stripe Customer ID from Supabase
-        stripe_customer_id = None
-        try:
-            from supabase import create_client
-            supabase_url = os.getenv("SUPABASE_URL")
-            supabase_key = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or os.getenv("SUPABASE_KEY")
-            supabase_client = create_client(supabase_url, supabase_key)
-            
-            profile_res = supabase_client.table('profiles').select('stripe_customer_id').eq('id', user_id).single().execute()
-            if profile_res.data:
-                stripe_customer_id = profile_res.data.get('stripe_customer_id')
-                print(f"DEBUG CHECKOUT: Found existing stripe_customer_id: {stripe_customer_id}")
-        except Exception as e:
-            print(f"DEBUG CHECKOUT: Error fetching customer_id from DB: {e}")
-
-        # Retrieve the price to check for product metadata (trial_days)
-        price = stripe.Price.retrieve(price_id, expand=['product'])
+        # 1. The existing Stripe Customer ID from Supabase, and the price with its product
+        #    metadata (trial_days). Both clients are blocking, so they run in worker threads, concurrently.
+        stripe_customer_id, price = await asyncio.gather(
+            asyncio.to_thread(find_stripe_customer_id, user_id),
+            asyncio.to_thread(stripe.Price.retrieve, price_id, expand=['product'])
+        )
         product = price.product
         
         # Extract trial days from product metadata (default to 0)
@@ -105,28 +263,10 @@ async def create_checkout_session(data: dict):
             print(f"DEBUG CHECKOUT: Target product has {trial_days} trial days. Checking for prior subs for {customer_email}...")
             
             # Enforce One-Time Trial Logic (Robust Check)
-            # 1. Search ALL customers with this email to avoid duplicates hiding history
-            customers = stripe.Customer.list(email=customer_email, limit=100)
-            
-            has_prior_subscription = False
-            active_sub = None
-
-            if customers.data:
-                for customer in customers.data:
-                    # Check for any subscriptions (active, canceled, past due, etc.)
-                    subscriptions = stripe.Subscription.list(customer=customer.id, status='all', limit=100)
-                    for sub in subscriptions.data:
-                        # If user has an ACTIVE or TRIALING subscription right now
-                        if sub.status in ['active', 'trialing']:
-                            active_sub = sub
-                        
-                        # Check for ANY history
-                        if sub.status in ['active', 'trialing', 'canceled', 'past_due', 'unpaid', 'incomplete_expired']:
-                             has_prior_subscription = True
-                             print(f"DEBUG: Found prior sub {sub.id} (status={sub.status}) for customer {customer.id}")
-                    
-                    if has_prior_subscription: 
-                        break
+            has_prior_subscription, active_sub = await singleflight.do(
+                ("subscription-history", (customer_email or "").lower()),
+                find_subscription_history, customer_email
+            )
 
             if active_sub:
                 print(f"DEBUG CHECKOUT: Active/Trialing subscription found for {customer_email}. Switch initiated.")
@@ -146,32 +286,39 @@ async def create_checkout_session(data: dict):
                      session_params['subscription_data'].pop('trial_end', None)
 
         print(f"DEBUG CHECKOUT: Creating session with params: {session_params}")
-        session = stripe.checkout.Session.create(**session_params)
+        session = await asyncio.to_thread(stripe.checkout.Session.create, **session_params)
         return {"url": session.url}
     except Exception as e:
         print(f"DEBUG CHECKOUT ERROR: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def create_portal_url(customer_id, email):
+    if not customer_id and email:
+        # Fallback: find customer by email
+        customers = stripe.Customer.list(email=email, limit=1)
+        if customers.data:
+            customer_id = customers.data[0].id
+
+    if not customer_id:
+         raise HTTPException(status_code=400, detail="Customer ID not found. Please contact support.")
+
+    session = stripe.billing_portal.Session.create(
+        customer=customer_id,
+        return_url=f"{os.getenv('FRONTEND_URL', 'http://localhost:3000')}/dashboard/settings/subscription",
+    )
+    return session.url
+
 @app.post("/create-portal-session")
 async def create_portal_session(data: dict):
     try:
         customer_id = data.get("customer_id")
         email = data.get("email")
 
-        if not customer_id and email:
-            # Fallback: find customer by email
-            customers = stripe.Customer.list(email=email, limit=1)
-            if customers.data:
-                customer_id = customers.data[0].id
-
-        if not customer_id:
-             raise HTTPException(status_code=400, detail="Customer ID not found. Please contact support.")
-
-        session = stripe.billing_portal.Session.create(
-            customer=customer_id,
-            return_url=f"{os.getenv('FRONTEND_URL', 'http://localhost:3000')}/dashboard/settings/subscription",
-        )
-        return {"url": session.url}
+        # Double-clicks for the same customer share one portal session
+        url = await singleflight.do(("portal", customer_id, (email or "").lower()), create_portal_url, customer_id, email)
+        return {"url": url}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -257,31 +404,8 @@ async def cancel_subscription(data: dict):
         print(f"Cancel Error: {e}") 
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
-@app.post("/webhook")
-async def stripe_webhook(request: Request):
-    payload = await request.body()
-    sig_header = request.headers.get('stripe-signature')
-
-    try:
-        event = stripe.Webhook.construct_event(
-            payload, sig_header, os.getenv('STRIPE_WEBHOOK_SECRET')
-        )
-        print(f"DEBUG WEBHOOK: Received event type '{event['type']}'", flush=True)
-    except ValueError as e:
-        print(f"DEBUG WEBHOOK ERROR (Payload): {e}")
-        raise HTTPException(status_code=400, detail='Invalid payload')
-    except stripe.error.SignatureVerificationError as e:
-        print(f"DEBUG WEBHOOK ERROR (Signature): {e}")
-        raise HTTPException(status_code=400, detail='Invalid signature')
-
-    from supabase import create_client, Client
-    url = os.getenv("SUPABASE_URL")
-    key = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or os.getenv("SUPABASE_KEY")
-    if not key:
-        print("WEBHOOK CRASH: No SUPABASE_SERVICE_ROLE_KEY or SUPABASE_KEY found in .env", flush=True)
-        return {"status": "error", "message": "Backend Config Error"}
-    supabase: Client = create_client(url, key)
-
+def handle_stripe_event(event, supabase):
+    """Applies a Stripe event to Supabase. Shared by /webhook and the startup catch-up."""
     if event['type'] == 'checkout.session.completed':
         session = event['data']['object']
         print(f"WEBHOOK: Session {session.get('id')} completed.", flush=True)
@@ -309,7 +433,12 @@ async def stripe_webhook(request: Request):
                         limit=20
                     )
                     
+                    new_sub_created = next((s.created for s in existing_subs.data if s.id == new_subscription_id), None)
+                    
                     for sub in existing_subs.data:
+                        # Never cancel a subscription newer than this checkout (replayed / out-of-order events)
+                        if new_sub_created and sub.created > new_sub_created:
+                            continue
                         # If subscription is active/trialing AND it's NOT the one we just created
                         if sub.status in ['active', 'trialing'] and sub.id != new_subscription_id:
                             print(f"SWITCHING: Found old subscription {sub.id} ({sub.status}). Canceling IMMEDIATELY...", flush=True)
@@ -404,139 +533,145 @@ async def stripe_webhook(request: Request):
             supabase.table('profiles').upsert(update_data).execute()
             print(f"WEBHOOK: Profile {user_id} cancelled.", flush=True)
     
+    elif event['type'].startswith(('product.', 'price.')):
+        # Catalog changed in Stripe, next GET /products reloads it (in every API worker)
+        cache_bus.publish("products")
+        print(f"WEBHOOK: Product catalog invalidated by {event['type']}", flush=True)
+
     else:
         print(f"WEBHOOK: Ignored event type {event['type']}", flush=True)
 
-    return {"status": "success"}
+@app.post("/webhook")
+async def stripe_webhook(request: Request):
+    payload = await request.body()
+    sig_header = request.headers.get('stripe-signature')
 
+    try:
+        event = stripe.Webhook.construct_event(
+            payload, sig_header, os.getenv('STRIPE_WEBHOOK_SECRET')
+        )
+        print(f"DEBUG WEBHOOK: Received event type '{event['type']}'", flush=True)
+    except ValueError as e:
+        print(f"DEBUG WEBHOOK ERROR (Payload): {e}")
+        raise HTTPException(status_code=400, detail='Invalid payload')
+    except stripe.error.SignatureVerificationError as e:
+        print(f"DEBUG WEBHOOK ERROR (Signature): {e}")
+        raise HTTPException(status_code=400, detail='Invalid signature')
 
-    return {"status": "success"}
+    from supabase import create_client, Client
+    url = os.getenv("SUPABASE_URL")
+    key = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or os.getenv("SUPABASE_KEY")
+    if not key:
+        print("WEBHOOK CRASH: No SUPABASE_SERVICE_ROLE_KEY or SUPABASE_KEY found in .env", flush=True)
+        return {"status": "error", "message": "Backend Config Error"}
+    supabase: Client = create_client(url, key)
 
-@app.post("/sync-subscription")
-async def sync_subscription(data: dict):
-    try:
-        email = data.get("email")
-        if not email:
-            raise HTTPException(status_code=400, detail="Email required")
-            
-        # 1. Find Customer
-        customers = stripe.Customer.list(email=email, limit=100)
-        target_sub = None
-        
-        # 2. Find Subscription (Prioritize 'active')
-        sub_list = []
-        for cust in customers.data:
-            subs = stripe.Subscription.list(customer=cust.id, limit=10)
-            sub_list.extend(subs.data)
-        
-        # Sort so 'active' comes before 'trialing' etc.
-        def sub_priority(s):
-            if s.status == 'active': return 0
-            if s.status == 'trialing': return 1
-            if s.status in ['past_due', 'unpaid']: return 2
-            return 3
-        
-        sorted_subs = sorted(sub_list, key=sub_priority)
-        if sorted_subs:
-            target_sub = sorted_subs[0]
-            
-        # 3. Determine Status
-        status = 'free'
-        trial_end = None
-        
-        if target_sub:
-            status = target_sub.status
-            # Logic: If canceling at period end, we treat it as 'cancelled' for the DB/UI
-            if target_sub.cancel_at_period_end:
-                status = 'cancelled'
-            
-            if target_sub.trial_end:
-                from datetime import datetime
-                try:
-                     trial_end = datetime.fromtimestamp(target_sub.trial_end).isoformat()
-                except:
-                     trial_end = None
-
-        # 4. Update Supabase
-        # Always resolve user_id by email from Supabase first to ensure we target the valid, current user
-        # (Handling case where user re-signed up but Stripe has old ID)
-        current_user_id = data.get("user_id") # Use ID provided by frontend if available (SUB ID)
-        
-        if not current_user_id:
-             try:
-                 from supabase import create_client
-                 url: str = os.getenv("SUPABASE_URL")
-                 key = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or os.getenv("SUPABASE_KEY")
-                 supabase_admin = create_client(url, key)
-                 
-                 response = supabase_admin.auth.admin.list_users()
-                 users = getattr(response, 'users', response if isinstance(response, list) else [])
-                 for u in users:
-                     if u.email == email:
-                         current_user_id = u.id
-                         print(f"DEBUG SYNC: Resolved current user_id {current_user_id} via Supabase Admin search.", flush=True)
-                         break
-             except Exception as auth_err:
-                 print(f"Warning: SYNC AUTH LOOKUP FAILED: {auth_err}", flush=True)
+    handle_stripe_event(event, supabase)
+    record_processed_event(supabase, event)
 
-        if not current_user_id and target_sub:
-             # Fallback to metadata ONLY if we couldn't find user by email/frontend
-             current_user_id = target_sub.metadata.get('user_id')
+    return {"status": "success"}
 
-        if current_user_id:
-             user_id = current_user_id # Use the resolved ID
+def sync_subscription_for(email, user_id=None):
+    """Reconciles a single user's profile with Stripe (the bulk version lives in subscription_reconciler)."""
+    # 1. Find Customer
+    customers = stripe.Customer.list(email=email, limit=100)
+    target_sub = None
+    
+    # 2. Find Subscription (Prioritize 'active')
+    sub_list = []
+    for cust in customers.data:
+        subs = stripe.Subscription.list(customer=cust.id, limit=10)
+        sub_list.extend(subs.data)
+    
+    sorted_subs = sorted(sub_list, key=subscription_priority)
+    if sorted_subs:
+        target_sub = sorted_subs[0]
+
+    # 3. Update Supabase
+    # Always resolve user_id by email from Supabase first to ensure we target the valid, current user
+    # (Handling case where user re-signed up but Stripe has old ID)
+    current_user_id = user_id # Use ID provided by frontend if available (SUB ID)
+    
+    if not current_user_id:
+         try:
              from supabase import create_client
              url: str = os.getenv("SUPABASE_URL")
              key = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or os.getenv("SUPABASE_KEY")
-             supabase = create_client(url, key)
+             supabase_admin = create_client(url, key)
              
-             update_data = {
-                 'id': user_id,
-                 'status': status,
-                 'updated_at': 'now()',
-             }
-             
-             # Sync the tier if available in metadata
-             plan_tier_id = target_sub.metadata.get('plan_tier_id') if target_sub else None
+             response = supabase_admin.auth.admin.list_users()
+             users = getattr(response, 'users', response if isinstance(response, list) else [])
+             for u in users:
+                 if u.email == email:
+                     current_user_id = u.id
+                     print(f"DEBUG SYNC: Resolved current user_id {current_user_id} via Supabase Admin search.", flush=True)
+                     break
+         except Exception as auth_err:
+             print(f"Warning: SYNC AUTH LOOKUP FAILED: {auth_err}", flush=True)
+
+    if not current_user_id and target_sub:
+         # Fallback to metadata ONLY if we couldn't find user by email/frontend
+         current_user_id = target_sub.metadata.get('user_id')
+
+    if current_user_id:
+         user_id = current_user_id # Use the resolved ID
+         from supabase import create_client
+         url: str = os.getenv("SUPABASE_URL")
+         key = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or os.getenv("SUPABASE_KEY")
+         supabase = create_client(url, key)
+         
+         # Sync the tier if available in metadata
+         plan_tier_id = target_sub.metadata.get('plan_tier_id') if target_sub else None
+         
+         # Fallback: If plan_tier_id is missing but we have a subscription, check the Product metadata
+         if target_sub and not plan_tier_id:
+             try:
+                 print(f"DEBUG SYNC: plan_tier_id missing on subscription {target_sub.id}. Fetching product...", flush=True)
+                 # target_sub.plan.product is usually an ID string unless expanded
+                 product_id = target_sub.plan.product
+                 if product_id:
+                     prod = stripe.Product.retrieve(product_id)
+                     print(f"DEBUG SYNC: Product {product_id} metadata: {prod.metadata}", flush=True)
+                     plan_tier_id = prod.metadata.get('plan_tier_id')
+                     print(f"DEBUG SYNC: Recovered plan_tier_id '{plan_tier_id}' from product {product_id}", flush=True)
+             except Exception as e:
+                 print(f"Warning: SYNC PRODUCT LOOKUP FAILED: {e}", flush=True)
+
+         # Same derivation the bulk reconciler uses, so both paths agree
+         update_data = {
+             'id': user_id,
+             'updated_at': 'now()',
+             **derive_profile_state(target_sub, plan_tier_id)
+         }
+         status = update_data['status']
+         print(f"DEBUG SYNC: Tier {update_data.get('subscription_tier')} for {user_id}. Status set to: {status}", flush=True)
              
-             # Fallback: If plan_tier_id is missing but we have a subscription, check the Product metadata
-             if target_sub and not plan_tier_id:
-                 try:
-                     print(f"DEBUG SYNC: plan_tier_id missing on subscription {target_sub.id}. Fetching product...", flush=True)
-                     # target_sub.plan.product is usually an ID string unless expanded
-                     product_id = target_sub.plan.product
-                     if product_id:
-                         prod = stripe.Product.retrieve(product_id)
-                         print(f"DEBUG SYNC: Product {product_id} metadata: {prod.metadata}", flush=True)
-                         plan_tier_id = prod.metadata.get('plan_tier_id')
-                         print(f"DEBUG SYNC: Recovered plan_tier_id '{plan_tier_id}' from product {product_id}", flush=True)
-                 except Exception as e:
-                     print(f"Warning: SYNC PRODUCT LOOKUP FAILED: {e}", flush=True)
-
-             if plan_tier_id:
-                 update_data['subscription_tier'] = plan_tier_id
-                 # If we have a paid tier, we'll treat the status as 'active' for the UI/DB
-                 # unless it's explicitly cancelled at period end
-                 if status != 'cancelled':
-                     update_data['status'] = 'active'
-                 print(f"DEBUG SYNC: Found tier {plan_tier_id} for {user_id}. Status set to: {update_data.get('status', status)}", flush=True)
-
-             if status == 'free' and not plan_tier_id:
-                 update_data['subscription_tier'] = 'free' # Explicitly reset tier
-
-             if trial_end:
-                 update_data['trial_end'] = trial_end
-                 
-             supabase.table('profiles').upsert(update_data).execute()
-             print(f"SYNC: Force updated profile {user_id} to {status}", flush=True)
-             return {"status": "success", "profile_status": status}
-        
-        return {"status": "skipped", "message": "No linked user_id found"}
+         supabase.table('profiles').upsert(update_data).execute()
+         print(f"SYNC: Force updated profile {user_id} to {status}", flush=True)
+         return {"status": "success", "profile_status": status}
+    
+    return {"status": "skipped", "message": "No linked user_id found"}
+
+@app.post("/sync-subscription")
+async def sync_subscription(data: dict):
+    try:
+        email = data.get("email")
+        if not email:
+            raise HTTPException(status_code=400, detail="Email required")
 
+        # Repeated dashboard calls for the same user share one in-flight sync
+        user_id = data.get("user_id")
+        return await singleflight.do(("sync-subscription", email.lower(), user_id), sync_subscription_for, email, user_id)
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Sync Error: {e}", flush=True)
         raise HTTPException(status_code=500, detail=str(e))
 
+# Upper bound on how long /send-invite waits for its queued message to go out
+INVITE_SEND_TIMEOUT = 60
+MAX_INVITES_PER_BATCH = 200
+
 @app.post("/send-invite")
 async def send_invite(data: dict):
     email = data.get("email")
@@ -545,55 +680,49 @@ async def send_invite(data: dict):
     if not email:
         raise HTTPException(status_code=400, detail="Email is required")
 
-    try:
-        # Standard SMTP Configuration (Gmail Example)
-        SMTP_SERVER = "smtp.gmail.com"
-        SMTP_PORT = 587
-        SENDER_EMAIL = os.getenv("EMAIL_USER")
-        SENDER_PASSWORD = os.getenv("EMAIL_PASSWORD") 
-        
-        if not SENDER_EMAIL or not SENDER_PASSWORD:
-             raise HTTPException(status_code=500, detail="Server email configuration missing (EMAIL_USER/EMAIL_PASSWORD)")
-
-        frontend_url = os.getenv('FRONTEND_URL', 'http://localhost:3000')
-        invite_link = f"{frontend_url}/signup?email={email}"
-        
-        # Construct Email
-        import smtplib
-        from email.mime.text import MIMEText
-        from email.mime.multipart import MIMEMultipart
-
-        msg = MIMEMultipart()
-        msg['From'] = f"Project Pulse <{SENDER_EMAIL}>"
-        msg['To'] = email
-        msg['Subject'] = "You've been invited to join the team on Project Pulse!"
-
-        html_content = f"""
-        <div style="font-family: sans-serif; max-width: 600px; margin: 0 auto;">
-            <h1 style="color: #4F46E5;">Welcome to the Team!</h1>
-            <p>You've been invited to join Project Pulse as a <strong>{role}</strong>.</p>
-            <p>Click the button below to accept your invitation and get started.</p>
-            <a href="{invite_link}" style="display: inline-block; background-color: #4F46E5; color: white; padding: 12px 24px; text-decoration: none; border-radius: 6px; font-weight: bold; margin-top: 16px;">Accept Invitation</a>
-            <p style="margin-top: 24px; color: #666; font-size: 12px;">If you were not expecting this invite, please ignore this email.</p>
-        </div>
-        """
-        
-        msg.attach(MIMEText(html_content, 'html'))
+    if not mail_service.is_configured():
+        raise HTTPException(status_code=500, detail="Server email configuration missing (EMAIL_USER/EMAIL_PASSWORD)")
 
-        # Send Email
-        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-        server.starttls()
-        server.login(SENDER_EMAIL, SENDER_PASSWORD)
-        server.send_message(msg)
-        server.quit()
-
-        print(f"EMAIL (SMTP): Invite sent to {email}", flush=True)
+    try:
+        # Goes through the pooled mail queue; we still wait so the caller sees delivery errors
+        _, jobs = mail_service.mail_queue.enqueue_invites([{"email": email, "role": role}])
+        await asyncio.wait_for(asyncio.shield(jobs[0].future), timeout=INVITE_SEND_TIMEOUT)
         return {"status": "success"}
-        
+    except asyncio.TimeoutError:
+        # Still queued, it will go out when the SMTP server catches up
+        return {"status": "queued"}
     except Exception as e:
         print(f"EMAIL ERROR: {e}", flush=True)
         raise HTTPException(status_code=500, detail=f"Failed to send email: {str(e)}")
 
+@app.post("/send-invites")
+async def send_invites(data: dict):
+    """Bulk invite: queues every invite and returns a batch ID to poll for delivery status."""
+    invites = data.get("invites")
+    if invites is None and data.get("emails"):
+        invites = [{"email": e, "role": data.get("role")} for e in data.get("emails")]
+
+    invites = [i for i in (invites or []) if i.get("email")]
+    if not invites:
+        raise HTTPException(status_code=400, detail="At least one invite with an email is required")
+    if len(invites) > MAX_INVITES_PER_BATCH:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_INVITES_PER_BATCH} invites per request")
+
+    if not mail_service.is_configured():
+        raise HTTPException(status_code=500, detail="Server email configuration missing (EMAIL_USER/EMAIL_PASSWORD)")
+
+    batch_id, jobs = mail_service.mail_queue.enqueue_invites(invites)
+    print(f"EMAIL: Queued {len(jobs)} invites (batch {batch_id})", flush=True)
+    return {"status": "queued", "batch_id": batch_id, "queued": len(jobs), "status_url": f"/invites/{batch_id}"}
+
+@app.get("/invites/{batch_id}")
+async def get_invite_batch(batch_id: str):
+    # Falls back to Supabase for batches queued by another API worker
+    report = await asyncio.to_thread(mail_service.mail_queue.batch_status, batch_id)
+    if not report:
+        raise HTTPException(status_code=404, detail="Unknown invite batch")
+    return report
+
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,69 +1,219 @@
 import discord
 from discord.ext import commands
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from services.supabase_client import get_messages_last_24h, check_guild_subscription
-from services.ai_service import generate_summary
+from apscheduler.triggers.cron import CronTrigger
+from services.supabase_client import get_messages_last_24h, get_latest_message_id, get_messages_since, check_guild_subscription
+from services.ai_service import generate_summary, SUMMARY_UNAVAILABLE, SUMMARY_FAILED
+from services.message_claims import message_claims
+from services.outbox import outbox, PRIORITY_ALERT
+from services.leases import LeaderLease
+from services.guild_settings import guild_settings, GUILD_SETTINGS_REFRESH_SECONDS
+from config import DAILY_PULSE_TIMEZONE, DAILY_PULSE_WINDOW_MINUTES, DAILY_PULSE_CONCURRENCY
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+import asyncio
+import time
+import zlib
 import os
 
+# Cached summaries are updated incrementally with new messages, but rebuilt from the full
+# 24h window after this long so topics that have aged out of the window drop off
+SUMMARY_REBUILD_SECONDS = 6 * 3600
+
+def pulse_offset_seconds(guild_id, window_minutes=DAILY_PULSE_WINDOW_MINUTES):
+    """Deterministic per-guild offset into the posting window, stable across restarts and instances."""
+    window = max(1, window_minutes * 60)
+    return zlib.crc32(str(guild_id).encode()) % window
+
+def pulse_timezone(name):
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        print(f"Warning: Unknown Daily Pulse timezone '{name}', using {DAILY_PULSE_TIMEZONE}")
+        return ZoneInfo(DAILY_PULSE_TIMEZONE)
+
 class Summary(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.scheduler = AsyncIOScheduler()
-        
-        # Schedule the job to run every day at 9 AM (server time)
+        # guild_id -> (timezone, hour, minute, second) currently scheduled
+        self.schedules = {}
+        # guild_id -> {"summary", "newest_id", "built_at"}: last summary and the newest message it covers
+        self.summaries = {}
+        # guild_id -> lock, so a manual summary overlapping the scheduled one waits and reuses its result
+        self.summary_locks = {}
+        self.sync_task = None
+        # Caps concurrent summary generation, so load stays flat however many guilds share a slot
+        self.generation_slots = asyncio.Semaphore(DAILY_PULSE_CONCURRENCY)
+
+        # Every instance schedules the jobs, only the lease holder runs them. Instances running
+        # different shards see different guilds, so each shard group elects its own leader.
+        shards = ",".join(str(i) for i in sorted(bot.shard_ids)) if getattr(bot, "shard_ids", None) else "all"
+        self.lease = LeaderLease(f"daily-pulse:{shards}")
+
+        # One cron job per guild at its local hour (guild_settings), spread over the window after it
         print(f"DEBUG: Starting Daily Pulse scheduler on Instance (PID: {os.getpid()})")
-        self.scheduler.add_job(self.post_daily_summary, 'cron', hour=9, minute=0)
         self.scheduler.start()
 
-    async def post_daily_summary(self):
-        print("Checking guilds for Daily Pulse...")
-        
-        for guild in self.bot.guilds:
-            # Plan Tier Enforcement
-            is_active, _ = check_guild_subscription(guild.id)
-            if not is_active:
-                continue
+    async def cog_load(self):
+        self.lease.start()
+        self.sync_task = asyncio.create_task(self._sync_schedules_loop())
+
+    async def cog_unload(self):
+        if self.sync_task:
+            self.sync_task.cancel()
+        self.scheduler.shutdown(wait=False)
+        await self.lease.stop()
+
+    async def _sync_schedules_loop(self):
+        await self.bot.wait_until_ready()
+        # Scheduling on the defaults first would post at the wrong hour until the next pass
+        await guild_settings.wait_loaded()
+        while True:
+            try:
+                self.sync_schedules()
+            except Exception as e:
+                print(f"Error scheduling Daily Pulse jobs: {e}")
+            # guild_settings reloads on the same interval, so edits are picked up on the next pass
+            await asyncio.sleep(GUILD_SETTINGS_REFRESH_SECONDS)
+
+    def schedule_guild(self, guild_id):
+        settings = guild_settings.get(guild_id)
+        offset = pulse_offset_seconds(guild_id)
+        spec = (settings["timezone"], int(settings["summary_hour"]) % 24, offset // 60, offset % 60)
+        if self.schedules.get(guild_id) == spec:
+            return
+        tz, hour, minute, second = spec
+        # Offsets past the hour roll into the next one
+        trigger = CronTrigger(hour=(hour + minute // 60) % 24, minute=minute % 60, second=second,
+                              timezone=pulse_timezone(tz))
+        self.scheduler.add_job(self.run_scheduled_summary, trigger, args=[guild_id],
+                               id=f"daily-pulse:{guild_id}", replace_existing=True,
+                               misfire_grace_time=600, coalesce=True)
+        self.schedules[guild_id] = spec
+
+    def unschedule_guild(self, guild_id):
+        self.summaries.pop(guild_id, None)
+        self.summary_locks.pop(guild_id, None)
+        if self.schedules.pop(guild_id, None) is not None:
+            try:
+                self.scheduler.remove_job(f"daily-pulse:{guild_id}")
+            except Exception:
+                pass
+
+    def sync_schedules(self):
+        current = {guild.id for guild in self.bot.guilds}
+        for guild_id in current:
+            self.schedule_guild(guild_id)
+        for guild_id in set(self.schedules) - current:
+            self.unschedule_guild(guild_id)
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild):
+        await guild_settings.wait_loaded()
+        self.schedule_guild(guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self.unschedule_guild(guild.id)
+
+    async def run_scheduled_summary(self, guild_id):
+        if not self.lease.is_leader:
+            print(f"Skipping Daily Pulse on Instance (PID: {os.getpid()}): not the {self.lease.name} leader")
+            return
+        guild = self.bot.get_guild(guild_id)
+        if guild:
+            await self.post_guild_summary(guild)
+
+    def _format_logs(self, messages):
+        return "\n".join([f"{m['username']}: {m['content']}" for m in messages])
+
+    async def build_guild_summary(self, guild):
+        """
+        The guild's summary, or None if it has no messages. Reuses the cached summary when
+        nothing was logged since it was generated and otherwise folds just the new messages into it.
+        """
+        lock = self.summary_locks.setdefault(guild.id, asyncio.Lock())
+        async with lock:
+            return await self._build_guild_summary(guild)
 
-            target_channel = discord.utils.get(guild.channels, name='general')
-            if not target_channel:
-                continue
+    async def _build_guild_summary(self, guild):
+        cached = self.summaries.get(guild.id)
+        if cached and time.time() - cached["built_at"] < SUMMARY_REBUILD_SECONDS:
+            newest_id = await asyncio.to_thread(get_latest_message_id, guild.id)
+            if newest_id == cached["newest_id"]:
+                print(f"Daily Pulse for {guild.name}: no new messages, reusing cached summary")
+                return cached["summary"]
 
+            new_messages = await asyncio.to_thread(get_messages_since, guild.id, cached["newest_id"])
+            if new_messages:
+                async with self.generation_slots:
+                    print(f"Updating Daily Pulse for {guild.name} with {len(new_messages)} new messages...")
+                    summary = await asyncio.to_thread(generate_summary, self._format_logs(new_messages), cached["summary"])
+                if summary not in (SUMMARY_UNAVAILABLE, SUMMARY_FAILED):
+                    cached.update(summary=summary, newest_id=max(m["id"] for m in new_messages))
+                return summary
+
+        async with self.generation_slots:
             print(f"Generating Daily Pulse for {guild.name}...")
-            
+
             # 1. Fetch Logs (Filtered by guild for isolation)
-            messages = get_messages_last_24h(guild_id=guild.id)
-            
+            messages = await asyncio.to_thread(get_messages_last_24h, guild_id=guild.id)
+
             if not messages:
-                await target_channel.send("The Daily Pulse: No messages recorded in the last 24 hours.")
-                continue
+                self.summaries.pop(guild.id, None)
+                return None
 
-            # Format for AI
-            text_block = "\n".join([f"{m['username']}: {m['content']}" for m in messages])
+            # 2. Generate Summary (blocking Cohere call, keep it off the event loop)
+            summary = await asyncio.to_thread(generate_summary, self._format_logs(messages))
 
-            # 2. Generate Summary
-            summary = generate_summary(text_block)
+        if summary not in (SUMMARY_UNAVAILABLE, SUMMARY_FAILED):
+            self.summaries[guild.id] = {
+                "summary": summary,
+                "newest_id": max(m["id"] for m in messages),
+                "built_at": time.time()
+            }
+        return summary
 
-            # 3. Post
-            msg = f"""
-            📊 **The Daily Pulse: Executive Summary**
-            
-            {summary}
-            """
-            await target_channel.send(msg)
+    async def post_guild_summary(self, guild, target_channel=None):
+        # Plan Tier Enforcement
+        is_active, _ = await asyncio.to_thread(check_guild_subscription, guild.id)
+        if not is_active:
+            return
+
+        target_channel = target_channel or discord.utils.get(guild.channels, name='general')
+        if not target_channel:
+            return
+
+        summary = await self.build_guild_summary(guild)
+        if summary is None:
+            await outbox.send(target_channel, "The Daily Pulse: No messages recorded in the last 24 hours.", priority=PRIORITY_ALERT)
+            return
+
+        # 3. Post
+        msg = f"""
+        📊 **The Daily Pulse: Executive Summary**
+
+        {summary}
+        """
+        await outbox.send(target_channel, msg, priority=PRIORITY_ALERT)
 
     @commands.command()
     async def force_summary(self, ctx):
-        """Manually triggers the daily summary for testing."""
+        """Manually triggers this server's daily summary, posted in the current channel."""
         if not ctx.guild:
             return
 
-        is_active, sub_msg = check_guild_subscription(ctx.guild.id)
+        # Every bot instance sees the command, one answers it
+        if not await message_claims.claim(ctx.message.id, kind="summary"):
+            return
+
+        is_active, sub_msg = await asyncio.to_thread(check_guild_subscription, ctx.guild.id)
         if not is_active:
             await ctx.send(f"⚠️ **Subscription Required**: {sub_msg}")
             return
 
         await ctx.send("Generating summary manually...")
-        await self.post_daily_summary()
+        await self.post_guild_summary(ctx.guild, target_channel=ctx.channel)
 
 async def setup(bot):
     await bot.add_cog(Summary(bot))
@@ -1,17 +1,52 @@
 import discord
 from discord.ext import commands
-from services.ai_service import analyze_urgency, generate_followup_questions, generate_detailed_ticket
-from services.supabase_client import insert_message, check_guild_subscription, supabase
+from services.ai_service import (analyze_urgency_batch, URGENCY_FAILED, generate_detailed_ticket, stream_in_thread,
+                                 stream_followup_questions, stream_detailed_ticket, partial_ticket_summary)
+from services.supabase_client import insert_message, get_guild_plan, supabase
 from services.ticket_service import get_ticket_service
+from services.message_claims import message_claims
+from services.report_sessions import report_sessions
+from services.duplicate_index import duplicate_index
+from services.report_storm import report_storm
+from services.outbox import outbox, PRIORITY_ALERT
+from services.cache_bus import cache_bus
+from services.pipeline import Pipeline, Stage
+from services.prescore import prescorer, aged_priority, MANUAL_REPORT_SCORE
+from config import (TICKET_PROVIDER, PIPELINE_WORKERS, PIPELINE_QUEUE_SIZE, AI_TIER_WEIGHTS,
+                    CLASSIFY_BATCH_SIZE, CLASSIFY_BATCH_WINDOW_MS)
+import asyncio
+import time
 import json
 
 class Urgency(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.active_reports = {}
         self.ticket_service = get_ticket_service()
         self.notified_guilds = set() # Simple anti-spam for no-tier message
         self.notified_sessions = set() # Anti-spam for "I sent you a DM"
+        # (guild_id, user_id) -> the user's report job still in the pipeline; later messages merge into it
+        self.in_flight = {}
+        # Every stage queue is fair across guilds (deficit round-robin, weighted by plan tier once
+        # ingest has looked it up), so one noisy community can't starve the others of AI capacity.
+        # Ingest is fair too: otherwise a backed-up pipeline would still admit messages in arrival order.
+        # Classify takes micro-batches, so a burst of messages costs one LLM request per batch.
+        self.pipeline = Pipeline("reports", [
+            Stage(name, handler, workers=PIPELINE_WORKERS.get(name, 1), maxsize=PIPELINE_QUEUE_SIZE,
+                  key=self.job_guild, weight=self.job_weight, priority=self.job_priority, **batching)
+            for name, handler, batching in [
+                ("ingest", self.ingest_stage, {}),
+                ("classify", self.classify_stage,
+                 {"batch_size": CLASSIFY_BATCH_SIZE, "batch_seconds": CLASSIFY_BATCH_WINDOW_MS / 1000}),
+                ("ticket", self.ticket_stage, {}),
+                ("notify", self.notify_stage, {}),
+            ]
+        ], on_done=self.job_done)
+
+    async def cog_load(self):
+        self.pipeline.start()
+
+    async def cog_unload(self):
+        self.pipeline.stop()
 
     @commands.Cog.listener()
     async def on_message(self, message):
@@ -23,17 +58,21 @@ class Urgency(commands.Cog):
         # (They are finishing a report already validated by server check)
         # ---------------------------------------------------------
         if isinstance(message.channel, discord.DMChannel):
+            # Every bot instance gets this DM, only the one that claims it answers
+            if not await message_claims.claim(message.id):
+                return
+
             # Acknowledgment (Make it feel responsive)
             async with message.channel.typing():
-                ack_msg = await message.channel.send("Got it! I'm analyzing your additional details now...")
+                ack_msg = await outbox.send(message.channel, "Got it! I'm analyzing your additional details now...")
 
-            # Look for active session in memory
+            # Look for the active session (shared between bot processes: the report may have been handled on another shard)
             ticket_id = None
             original_issue = None
             guild_id = None
 
-            if message.author.id in self.active_reports:
-                session = self.active_reports.pop(message.author.id)
+            session = await report_sessions.pop(message.author.id)
+            if session:
                 ticket_id = session.get("ticket_id")
                 original_issue = session.get("content")
                 guild_id = session.get("guild_id")
@@ -73,8 +112,17 @@ class Urgency(commands.Cog):
             )
 
             if ticket_id:
-                # Generate Structured AI Report (now with follow-up)
-                ai_report = generate_detailed_ticket(original_issue, message.content)
+                # Generate Structured AI Report (now with follow-up), showing the summary as it's written
+                def drafting(text):
+                    summary = partial_ticket_summary(text)
+                    return f"{ack_msg.content}\n\n**Summary (drafting):** {summary}" if summary else ""
+                _, _, ai_report = await outbox.send_streamed(
+                    message.channel,
+                    stream_in_thread(stream_detailed_ticket, original_issue, message.content),
+                    render=drafting,
+                    message=ack_msg
+                )
+                ai_report = ai_report or {}
                 
                 # Construct the update report
                 report = {
@@ -93,8 +141,9 @@ class Urgency(commands.Cog):
                 success = self.ticket_service.update_ticket(ticket_id, report)
                 ticket_result = "Updated in Database" if success else "Update Failed"
 
-                # Thank the user
-                await message.channel.send(
+                # Thank the user (the acknowledgment becomes the final report)
+                await outbox.edit(
+                    ack_msg,
                     f"**Report Updated!**\n\n"
                     f"**Summary:** {report['summary']}\n"
                     f"**Priority:** {report['priority']}\n"
@@ -106,7 +155,7 @@ class Urgency(commands.Cog):
                 return
             else:
                 # If no session and no ticket, it's just a regular DM
-                await message.channel.send("Hey! If you have an issue to report, please post it in the server's `#report-issues-with-pulse` channel first.")
+                await outbox.send(message.channel, "Hey! If you have an issue to report, please post it in the server's `#report-issues-with-pulse` channel first.")
                 return
 
         # ---------------------------------------------------------
@@ -120,10 +169,86 @@ class Urgency(commands.Cog):
         if message.channel.name.lower() != "report-issues-with-pulse":
             return
 
-        # ---------------------------------------------------------
+        # One instance triages each message; the rest skip the LLM and ticket work
+        if not await message_claims.claim(message.id):
+            return
+
+        # A burst of messages from one user is one report: fold it into the job already in flight
+        key = (message.guild.id, message.author.id)
+        pending = self.in_flight.get(key)
+        if pending is not None:
+            self.merge_into(pending, message)
+            return
+
+        # Everything past the cheap filters runs in the report pipeline, off the event dispatch
+        job = {
+            "message": message,
+            "content": message.content,
+            "merged": [],
+            "merged_ids": [],
+            "received_at": time.monotonic(),
+            # Orders the guild's queue until the LLM score is known
+            "prescore": prescorer.score(message.content, message.author.id)
+        }
+        self.in_flight[key] = job
+        if not await self.pipeline.submit(job):
+            self.job_done(job)
+
+    def job_done(self, job):
+        message = job["message"]
+        key = (message.guild.id if message.guild else None, message.author.id)
+        if self.in_flight.get(key) is job:
+            del self.in_flight[key]
+
+    def merge_into(self, job, message):
+        print(f"DEBUG: Merging message from {message.author.name} into their report in flight")
+        job["merged"].append(message)
+        if "ticket_started" not in job:
+            # Still ahead of the ticket stage: triage and the ticket see the whole burst
+            job["content"] = f"{job['content']}\n{message.content}"
+        if job.get("logged"):
+            # Ingest already ran (and passed the plan check), log this one now
+            asyncio.create_task(self.log_merged(job, message))
+
+    async def log_merged(self, job, message):
+        message_id = await asyncio.to_thread(
+            insert_message,
+            message.author.id,
+            message.channel.id,
+            message.content,
+            message.author.name,
+            message.author.display_name,
+            str(message.author.display_avatar.url),
+            guild_id=message.guild.id
+        )
+        if not message_id:
+            return
+        job["merged_ids"].append(message_id)
+        if job.get("ticket_id"):
+            # Arrived after the ticket stage linked the burst, link it directly
+            from services.supabase_client import link_message_to_ticket
+            await asyncio.to_thread(link_message_to_ticket, message_id, job["ticket_id"])
+
+    # ---------------------------------------------------------
+    # REPORT PIPELINE: ingest -> classify -> ticket -> notify
+    # Each stage has its own worker pool and a bounded queue in front of it
+    # ---------------------------------------------------------
+    def job_guild(self, job):
+        guild = job["message"].guild
+        return guild.id if guild else None
+
+    def job_weight(self, job):
+        return AI_TIER_WEIGHTS.get(job.get("tier"), 1)
+
+    def job_priority(self, job):
+        # Likely-critical reports first (pre-score, then the real score once classified), aged so nothing starves
+        return aged_priority(job.get("score", job.get("prescore", 0)), job["received_at"])
+
+    async def ingest_stage(self, job):
+        message = job["message"]
+
         # 3. PLAN TIER ENFORCEMENT
-        # ---------------------------------------------------------
-        is_active, sub_msg = check_guild_subscription(message.guild.id)
+        is_active, sub_msg, job["tier"] = await asyncio.to_thread(get_guild_plan, message.guild.id)
         print(f"\nSUBSCRIPTION CHECK for Guild {message.guild.name} (ID: {message.guild.id})")
         print(f"   Active: {is_active}")
         print(f"   Message: {sub_msg}\n")
@@ -131,29 +256,71 @@ class Urgency(commands.Cog):
         if not is_active:
             # Only notify once per bot session per guild to avoid spam
             if message.guild.id not in self.notified_guilds:
-                await message.channel.send(f"**Subscription Required**: {sub_msg}")
+                await outbox.send(message.channel, f"**Subscription Required**: {sub_msg}")
                 self.notified_guilds.add(message.guild.id)
-            return
+            return None
 
         # Log every message (Only for subscribed guilds)
-        full_name = message.author.display_name
-        avatar_url = str(message.author.display_avatar.url)
-        message_id = insert_message(
+        job["message_id"] = await asyncio.to_thread(
+            insert_message,
             message.author.id, 
             message.channel.id, 
             message.content, 
             message.author.name, 
-            full_name, 
-            avatar_url,
+            message.author.display_name, 
+            str(message.author.display_avatar.url),
             guild_id=message.guild.id
         )
+        job["logged"] = True
+        for merged in list(job["merged"]):
+            await self.log_merged(job, merged)
 
         # Anti-Spam / Concurrent Report Check
-        if message.author.id in self.active_reports:
-            return
+        if await report_sessions.active(message.author.id):
+            return None
+
+        # Repeat of an open ticket (e.g. everyone reporting the same outage): attach it, skip the LLM
+        if TICKET_PROVIDER == "SUPABASE":
+            duplicate = await duplicate_index.find(message.guild.id, message.content)
+            if duplicate:
+                ticket_id, similarity = duplicate
+                print(f"DEBUG: Message from {message.author.name} matches ticket {ticket_id} (similarity {similarity:.2f})")
+                from services.supabase_client import link_message_to_ticket, record_duplicate_report
+                await asyncio.to_thread(link_message_to_ticket, job["message_id"], ticket_id)
+                await asyncio.to_thread(record_duplicate_report, ticket_id)
+                await outbox.react(message, "👀")
+                await outbox.reply(message, "Thanks! This looks like an issue we're already tracking, so I've added your report to the existing ticket.")
+                return None
+
+        return job
+
+    async def classify_stage(self, jobs):
+        # Urgency Check, one request per guild in the batch: a prompt never mixes servers' messages,
+        # so text in one community's report can't sway the scores of another's
+        by_guild = {}
+        for job in jobs:
+            by_guild.setdefault(self.job_guild(job), []).append(job)
+        groups = list(by_guild.values())
+        results = await asyncio.gather(*[
+            asyncio.to_thread(analyze_urgency_batch, [job["content"] for job in group])
+            for group in groups
+        ])
+        scored = {}
+        for group, group_results in zip(groups, results):
+            for job, result in zip(group, group_results):
+                scored[id(job)] = self.apply_urgency(job, result)
+        return [scored[id(job)] for job in jobs]
+
+    def apply_urgency(self, job, result):
+        if result == URGENCY_FAILED:
+            # Cohere is failing or over budget: triage on the cheap pre-score rather than dropping the report
+            score = round(job.get("prescore", 0))
+            if score < 5:
+                return None
+            job["score"] = score
+            job["reason"] = "Estimated from the message (AI triage unavailable)"
+            return job
 
-        # Urgency Check 
-        result = analyze_urgency(message.content)
         # Result format: "Score|Reason"
         try:
             if "|" in result:
@@ -163,87 +330,127 @@ class Urgency(commands.Cog):
                 reason = "No reason provided by AI"
             
             score = int(score_str)
+        except ValueError:
+            return None
 
-            if score >= 5:
-                # Create Ticket IMMEDIATELY (Preliminary Report)
-                pre_report = generate_detailed_ticket(message.content, "")
-                ticket_data = {
-                    "user": message.author.name,
-                    "full_name": message.author.display_name,
-                    "avatar_url": str(message.author.display_avatar.url),
-                    "user_id": str(message.author.id),
-                    "guild_id": str(message.guild.id),
-                    "original_issue": message.content,
-                    "follow_up_details": "Pending...",
-                    "summary": pre_report.get("summary", "New report from Discord"),
-                    "type": pre_report.get("type", "Support"),
-                    "priority": pre_report.get("priority", "Medium"),
-                    "location": pre_report.get("location", "Unknown"),
-                    "solution": pre_report.get("solution", "Analyzing report..."),
-                    "urgency_score": score,
-                    "origin_channel_id": str(message.channel.id),
-                    "status": "OPEN"
-                }
-                
-                # Create ticket and get ID
-                ticket_id = self.ticket_service.create_ticket(ticket_data)
-
-                # LINK ORIGINAL MESSAGE TO TICKET
-                from services.supabase_client import link_message_to_ticket
-                link_message_to_ticket(message_id, ticket_id)
-
-                # START ACTIVE TRACKING
-                self.active_reports[message.author.id] = {
-                    "content": message.content,
-                    "score": score,
-                    "channel_id": message.channel.id,
-                    "guild_id": message.guild.id,
-                    "ticket_id": ticket_id
+        prescorer.observe(job["message"].author.id, score)
+        if score < 5:
+            return None
+        job["score"] = score
+        job["reason"] = reason
+        return job
+
+    async def ticket_stage(self, job):
+        message = job["message"]
+        content = job["content"]
+        score = job["score"]
+        manual = job.get("manual", False)
+        job["ticket_started"] = True
+
+        # Create Ticket IMMEDIATELY (Preliminary Report)
+        pre_report = await asyncio.to_thread(generate_detailed_ticket, content, "")
+        ticket_data = {
+            "user": message.author.name,
+            "full_name": message.author.display_name,
+            "avatar_url": str(message.author.display_avatar.url),
+            "user_id": str(message.author.id),
+            "guild_id": str(message.guild.id) if message.guild else None,
+            "original_issue": content,
+            "follow_up_details": "Manual Report - Initial" if manual else "Pending...",
+            "summary": pre_report.get("summary", "Manual report from Discord" if manual else "New report from Discord"),
+            "type": pre_report.get("type", "Support"),
+            "priority": pre_report.get("priority", "Medium"),
+            "location": pre_report.get("location", "Unknown"),
+            "solution": pre_report.get("solution", "Analyzing report..."),
+            "urgency_score": score,
+            "origin_channel_id": str(message.channel.id) if message.channel else None,
+            "status": "OPEN"
+        }
+        
+        # Create ticket and get ID
+        ticket_id = await asyncio.to_thread(self.ticket_service.create_ticket, ticket_data)
+        if TICKET_PROVIDER == "SUPABASE" and ticket_id and message.guild:
+            # Later repeats match this ticket here right away, and in other instances after their reload
+            duplicate_index.add(message.guild.id, ticket_id, content)
+            # Other instances drop their copy; ours was just extended, so skip the local handlers
+            asyncio.create_task(asyncio.to_thread(cache_bus.publish, "tickets", message.guild.id, local=False))
+
+        # LINK ORIGINAL MESSAGE (and any merged into it) TO TICKET
+        job["ticket_id"] = ticket_id
+        from services.supabase_client import link_message_to_ticket
+        for message_id in [job.get("message_id")] + job.get("merged_ids", []):
+            if message_id:
+                await asyncio.to_thread(link_message_to_ticket, message_id, ticket_id)
+
+        # START ACTIVE TRACKING
+        await report_sessions.put(message.author.id, {
+            "content": content,
+            "score": score,
+            "channel_id": message.channel.id,
+            "guild_id": message.guild.id if message.guild else None,
+            "ticket_id": ticket_id
+        })
+        return job
+
+    async def notify_stage(self, job):
+        message = job["message"]
+        content = job["content"]
+        score = job["score"]
+        reason = job["reason"]
+
+        if job.get("manual"):
+            # Manual reports: no admin alert, just the follow-up
+            try:
+                await outbox.send_streamed(message.author, stream_in_thread(stream_followup_questions, content))
+                await outbox.react(message, "📩")
+                await outbox.reply(message, "I've manually created a ticket for you and sent a DM for more details.")
+            except discord.Forbidden:
+                await outbox.reply(message, "Ticket created, but I couldn't DM you. Please check your settings!")
+            return None
+
+        # A. NOTIFY ADMINS (Private)
+        admin_channel_name = "dev"
+        admin_channel = discord.utils.get(message.guild.text_channels, name=admin_channel_name)
+        if not admin_channel:
+            admin_channel = discord.utils.get(message.guild.text_channels, name=".dev")
+        
+        if not admin_channel:
+            try:
+                print(f"DEBUG: Creating private {admin_channel_name} channel in {message.guild.name}")
+                overwrites = {
+                    message.guild.default_role: discord.PermissionOverwrite(read_messages=False),
+                    message.guild.me: discord.PermissionOverwrite(read_messages=True)
                 }
+                admin_channel = await message.guild.create_text_channel(admin_channel_name, overwrites=overwrites)
+            except discord.Forbidden:
+                print(f"Forbidden: Cannot create {admin_channel_name} in {message.guild.name}")
+            except Exception as e:
+                print(f"Failed to create {admin_channel_name} channel: {e}")
 
-                # A. NOTIFY ADMINS (Private)
-                admin_channel_name = "dev"
-                admin_channel = discord.utils.get(message.guild.text_channels, name=admin_channel_name)
-                if not admin_channel:
-                    admin_channel = discord.utils.get(message.guild.text_channels, name=".dev")
-                
-                if not admin_channel:
-                    try:
-                        print(f"DEBUG: Creating private {admin_channel_name} channel in {message.guild.name}")
-                        overwrites = {
-                            message.guild.default_role: discord.PermissionOverwrite(read_messages=False),
-                            message.guild.me: discord.PermissionOverwrite(read_messages=True)
-                        }
-                        admin_channel = await message.guild.create_text_channel(admin_channel_name, overwrites=overwrites)
-                    except discord.Forbidden:
-                        print(f"Forbidden: Cannot create {admin_channel_name} in {message.guild.name}")
-                    except Exception as e:
-                        print(f"Failed to create {admin_channel_name} channel: {e}")
-
-                if admin_channel:
-                    await admin_channel.send(
-                        f"Urgency Alert (Level {score}/10)\n"
-                        f"**User:** {message.author.mention}\n"
-                        f"**Reason:** {reason}\n"
-                        f"**Content:** {message.content}"
-                    )
-
-                # B. FOLLOW-UP WITH USER (Direct Message - Dynamic)
-                follow_up = generate_followup_questions(message.content)
-                
-                try:
-                    await message.author.send(follow_up)
-                    await message.add_reaction("📩")
-                    await message.reply("Hey! I've sent you a DM to get a few more details so we can help you faster.")
-                except discord.Forbidden:
-                    # Fallback if DMs are closed
-                    await message.reply("I tried to DM you follow-up questions but your DMs are closed. Please check your settings!")
-                    # Clean up active report since we can't DM them
-                    if message.author.id in self.active_reports:
-                        del self.active_reports[message.author.id]
+        if admin_channel and report_storm.record(message.guild.id, message.author.id, message.author.mention, score, reason):
+            # Report storm: fold it into the guild's single, periodically edited incident alert
+            await report_storm.alert(message.guild.id, admin_channel)
+        elif admin_channel:
+            await outbox.send(
+                admin_channel,
+                f"Urgency Alert (Level {score}/10)\n"
+                f"**User:** {message.author.mention}\n"
+                f"**Reason:** {reason}\n"
+                f"**Content:** {content}",
+                priority=PRIORITY_ALERT
+            )
 
-        except ValueError:
-            pass
+        # B. FOLLOW-UP WITH USER (Direct Message - Dynamic, streamed in as it's generated)
+        try:
+            await outbox.send_streamed(message.author, stream_in_thread(stream_followup_questions, content))
+            await outbox.react(message, "📩")
+            await outbox.reply(message, "Hey! I've sent you a DM to get a few more details so we can help you faster.")
+        except discord.Forbidden:
+            # Fallback if DMs are closed
+            await outbox.reply(message, "I tried to DM you follow-up questions but your DMs are closed. Please check your settings!")
+            # Clean up active report since we can't DM them
+            await report_sessions.discard(message.author.id)
+        return None
 
     @commands.command(name="report")
     async def manual_report(self, ctx, *, issue_content: str = None):
@@ -252,52 +459,31 @@ class Urgency(commands.Cog):
             await ctx.send("Please provide the issue description. Usage: `!report <describe your problem>`")
             return
 
+        if not await message_claims.claim(ctx.message.id, kind="report"):
+            return
+
         # Use the same logic as auto-detection but forced
+        tier = None
         if ctx.guild:
             # Check tier (reusing existing logic)
-            is_active, sub_msg = check_guild_subscription(ctx.guild.id)
+            is_active, sub_msg, tier = await asyncio.to_thread(get_guild_plan, ctx.guild.id)
             if not is_active:
                 await ctx.send(f"**Subscription Required**: {sub_msg}")
                 return
 
-        # Create ticket
-        pre_report = generate_detailed_ticket(issue_content, "")
-        ticket_data = {
-            "user": ctx.author.name,
-            "full_name": ctx.author.display_name,
-            "avatar_url": str(ctx.author.display_avatar.url),
-            "user_id": str(ctx.author.id),
-            "guild_id": str(ctx.guild.id) if ctx.guild else None,
-            "original_issue": issue_content,
-            "follow_up_details": "Manual Report - Initial",
-            "summary": pre_report.get("summary", "Manual report from Discord"),
-            "type": pre_report.get("type", "Support"),
-            "priority": pre_report.get("priority", "Medium"),
-            "location": pre_report.get("location", "Unknown"),
-            "solution": pre_report.get("solution", "Analyzing report..."),
-            "urgency_score": 7, # Manual reports get a fixed baseline high score
-            "origin_channel_id": str(ctx.channel.id) if ctx.channel else None,
-            "status": "OPEN"
-        }
-        
-        ticket_id = self.ticket_service.create_ticket(ticket_data)
-        
-        self.active_reports[ctx.author.id] = {
+        # Straight to the ticket stage: no triage needed, and the manual flag puts it ahead in the queue
+        accepted = await self.pipeline.submit({
+            "message": ctx.message,
             "content": issue_content,
-            "score": 7,
-            "channel_id": ctx.channel.id,
-            "guild_id": ctx.guild.id if ctx.guild else None,
-            "ticket_id": ticket_id
-        }
-
-        # Follow up
-        follow_up = generate_followup_questions(issue_content)
-        try:
-            await ctx.author.send(follow_up)
-            await ctx.message.add_reaction("📩")
-            await ctx.reply("I've manually created a ticket for you and sent a DM for more details.")
-        except discord.Forbidden:
-            await ctx.reply("Ticket created, but I couldn't DM you. Please check your settings!")
+            "manual": True,
+            "tier": tier,
+            "score": MANUAL_REPORT_SCORE, # Manual reports get a fixed baseline high score
+            "reason": "Manual report",
+            "received_at": time.monotonic()
+        }, stage="ticket")
+        if not accepted:
+            # Shed by the full ticket queue: no ticket was created, so say so instead of staying silent
+            await outbox.reply(ctx.message, "We're handling a lot of reports right now and couldn't take yours. Please try `!report` again in a minute.")
 
 async def setup(bot):
     await bot.add_cog(Urgency(bot))
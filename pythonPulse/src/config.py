@@ -1,4 +1,5 @@
 import os
+import socket
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -9,6 +10,71 @@ SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
 # GUILD_ID is no longer needed for global sync
 
+# Process role: "all" (bot + API in one process), "bot" or "api" (see main.py --mode)
+RUN_MODE = os.getenv("RUN_MODE", "all").lower()
+PORT = int(os.getenv("PORT", 8000))
+API_WORKERS = int(os.getenv("API_WORKERS", 1)) # uvicorn worker processes in "api" mode
+# Identifies this process to its peers (cache invalidations, claims, leases)
+INSTANCE_ID = os.getenv("INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+# Gateway / cache tuning
+# PRESENCE_TRACKING: "off" (no presences intent at all), "opt-in" (only guilds enabled in
+# guild_settings.presence_tracking or listed in PRESENCE_GUILD_IDS; the intent is only requested
+# if at least one guild has opted in when the bot starts, so new opt-ins need a restart) or "all"
+PRESENCE_TRACKING = os.getenv("PRESENCE_TRACKING", "opt-in").lower()
+PRESENCE_GUILD_IDS = {g.strip() for g in os.getenv("PRESENCE_GUILD_IDS", "").split(",") if g.strip()}
+# Size of discord.py's message cache (None = unbounded, 0 = disabled)
+BOT_MAX_MESSAGES = int(os.getenv("BOT_MAX_MESSAGES", 200))
+
+# Sharding (overridable with main.py flags). Unset = let Discord pick the count and run every shard here.
+SHARD_COUNT = int(os.getenv("SHARD_COUNT")) if os.getenv("SHARD_COUNT") else None
+SHARD_IDS = os.getenv("SHARD_IDS") # "0-3" or "0,1,2,3": the shards this process runs
+
+# Daily Pulse defaults (per-guild overrides: guild_settings.timezone / summary_hour)
+DAILY_PULSE_TIMEZONE = os.getenv("DAILY_PULSE_TIMEZONE", "UTC")
+DAILY_PULSE_HOUR = int(os.getenv("DAILY_PULSE_HOUR", 9))
+# Each guild's post lands at a fixed offset inside this window after its hour
+DAILY_PULSE_WINDOW_MINUTES = int(os.getenv("DAILY_PULSE_WINDOW_MINUTES", 60))
+# Summaries generated at once (Cohere + Supabase), regardless of guild count
+DAILY_PULSE_CONCURRENCY = int(os.getenv("DAILY_PULSE_CONCURRENCY", 2))
+
+# Report pipeline (cogs/urgency.py): worker tasks per stage and the bound on each stage's queue
+PIPELINE_WORKERS = {
+    name.strip(): int(count)
+    for name, _, count in (part.partition("=") for part in os.getenv(
+        "PIPELINE_WORKERS", "ingest=4,classify=4,ticket=2,notify=4").split(","))
+    if count.strip()
+}
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 100))
+# Urgency classification is micro-batched: each classify worker scores up to this many
+# queued messages in one LLM request, waiting at most this long for the batch to fill
+CLASSIFY_BATCH_SIZE = int(os.getenv("CLASSIFY_BATCH_SIZE", 8))
+CLASSIFY_BATCH_WINDOW_MS = int(os.getenv("CLASSIFY_BATCH_WINDOW_MS", 50))
+# Share of the AI stages each guild gets by plan tier (deficit round-robin weights)
+AI_TIER_WEIGHTS = {
+    name.strip(): float(weight)
+    for name, _, weight in (part.partition("=") for part in os.getenv(
+        "AI_TIER_WEIGHTS", "free=1,pro=2,enterprise=4").split(","))
+    if weight.strip()
+}
+
+# Cohere latency budgets in seconds, per kind of call: past it the call is abandoned and
+# the function's fallback is served
+COHERE_LATENCY_BUDGETS = {
+    name.strip(): float(seconds)
+    for name, _, seconds in (part.partition("=") for part in os.getenv(
+        "COHERE_LATENCY_BUDGETS", "urgency=6,followup=10,ticket=15,summary=60").split(","))
+    if seconds.strip()
+}
+# Triage calls still running after this many ms get a second, hedged request (0 = off)
+COHERE_HEDGE_AFTER_MS = int(os.getenv("COHERE_HEDGE_AFTER_MS", 2500))
+# Consecutive Cohere failures that open the circuit, and how long it stays open
+COHERE_BREAKER_FAILURES = int(os.getenv("COHERE_BREAKER_FAILURES", 5))
+COHERE_BREAKER_COOLDOWN_SECONDS = int(os.getenv("COHERE_BREAKER_COOLDOWN_SECONDS", 30))
+
+# Multi-instance coordination: "supabase" (message_claims table, for several bots on one token) or "local"
+MESSAGE_CLAIMS = os.getenv("MESSAGE_CLAIMS", "supabase").lower()
+
 
 # Ticketing Config
 TICKET_PROVIDER = os.getenv("TICKET_PROVIDER", "LOG").upper() # LOG, TRELLO, SUPABASE, GITHUB, JIRA
@@ -28,5 +94,17 @@ JIRA_EMAIL = os.getenv("JIRA_EMAIL")
 JIRA_API_TOKEN = os.getenv("JIRA_API_TOKEN")
 JIRA_PROJECT_KEY = os.getenv("JIRA_PROJECT_KEY")
 
-if not all([DISCORD_TOKEN, COHERE_API_KEY, SUPABASE_URL, SUPABASE_KEY]):
+# Settings each process role needs (checked by main.py for the selected mode)
+REQUIRED_SETTINGS = {
+    "bot": ["DISCORD_TOKEN", "COHERE_API_KEY", "SUPABASE_URL", "SUPABASE_KEY"],
+    "api": ["SUPABASE_URL", "SUPABASE_KEY"],
+}
+
+def missing_settings(mode):
+    roles = ["bot", "api"] if mode == "all" else [mode]
+    names = {name for role in roles for name in REQUIRED_SETTINGS.get(role, [])}
+    return sorted(name for name in names if not globals().get(name))
+
+# Every role talks to Supabase
+if not all([SUPABASE_URL, SUPABASE_KEY]):
     raise ValueError("Missing required environment variables. Please check your .env file.")
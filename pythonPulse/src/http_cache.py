@@ -0,0 +1,200 @@
+import gzip
+import json
+import time
+import hashlib
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+
+from fastapi import Response
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # Optional: without it we only negotiate gzip
+
+
+class CachedPayload:
+    """A JSON body plus the validators derived from its content."""
+
+    def __init__(self, data, last_modified):
+        self.body = json.dumps(data, separators=(",", ":"), sort_keys=True, default=str).encode("utf-8")
+        # Weak: the same content is served gzip/br/identity, which are not byte-identical
+        self.etag = 'W/"' + hashlib.sha256(self.body).hexdigest()[:32] + '"'
+        self.last_modified = last_modified
+        self.fetched_at = time.time()
+
+
+class CatalogCache:
+    """
+    In-memory cache for a read-only JSON catalog (e.g. the Stripe product list).
+    Last-Modified only moves when the content hash changes, so refreshes that
+    return the same catalog keep the validators browsers already hold.
+    """
+
+    def __init__(self, loader, ttl_seconds=60, stale_seconds=300):
+        self.loader = loader
+        self.ttl_seconds = ttl_seconds
+        self.stale_seconds = stale_seconds
+        self._entry = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Returns (entry, state) with state in 'fresh', 'stale' or 'missing'."""
+        entry = self._entry
+        if not entry:
+            return None, "missing"
+        age = time.time() - entry.fetched_at
+        if age < self.ttl_seconds:
+            return entry, "fresh"
+        if age < self.ttl_seconds + self.stale_seconds:
+            return entry, "stale"
+        return entry, "missing"
+
+    def refresh(self):
+        """Blocking reload from the loader. Run it in a thread (e.g. via SingleFlight)."""
+        data = self.loader()
+        now = time.time()
+        with self._lock:
+            previous = self._entry
+            entry = CachedPayload(data, now)
+            if previous and previous.etag == entry.etag:
+                entry.last_modified = previous.last_modified
+            self._entry = entry
+        return entry
+
+    def invalidate(self):
+        self._entry = None
+
+
+def _etag_matches(if_none_match, etag):
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison (RFC 9110 13.1.2): ignore the W/ prefix on both sides
+    wanted = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == wanted:
+            return True
+    return False
+
+
+def _not_modified_since(if_modified_since, last_modified):
+    try:
+        since = parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
+    # HTTP dates have second precision
+    return int(last_modified) <= int(since)
+
+
+def conditional_response(request, entry, max_age=60, stale_while_revalidate=300):
+    """Builds a 200 JSON response with validators, or a bodiless 304 if the client copy is current."""
+    headers = {
+        "ETag": entry.etag,
+        "Last-Modified": formatdate(entry.last_modified, usegmt=True),
+        "Cache-Control": f"public, max-age={max_age}, stale-while-revalidate={stale_while_revalidate}",
+        "Vary": "Accept-Encoding",
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        not_modified = _etag_matches(if_none_match, entry.etag)
+    else:
+        # If-Modified-Since is only consulted without If-None-Match
+        if_modified_since = request.headers.get("if-modified-since")
+        not_modified = bool(if_modified_since) and _not_modified_since(if_modified_since, entry.last_modified)
+
+    if not_modified:
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry.body, media_type="application/json", headers=headers)
+
+
+def choose_encoding(accept_encoding):
+    """Picks br or gzip from an Accept-Encoding header, honouring q-values. None means identity."""
+    weights = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name] = q
+
+    candidates = ["br", "gzip"] if brotli else ["gzip"]
+    best = None
+    for name in candidates:
+        q = weights.get(name, weights.get("*", 0.0))
+        if q > 0 and (best is None or q > best[1]):
+            best = (name, q)
+    return best[0] if best else None
+
+
+class JSONCompressionMiddleware:
+    """
+    ASGI middleware compressing JSON responses with brotli (if installed) or gzip.
+    Only buffers application/json bodies; everything else streams through untouched.
+    """
+
+    def __init__(self, app, minimum_size=500, gzip_level=6, brotli_quality=5):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if not encoding:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        passthrough = False
+        chunks = []
+
+        async def send_wrapper(message):
+            nonlocal start_message, passthrough
+            if message["type"] == "http.response.start":
+                start_message = message
+                headers = MutableHeaders(raw=start_message["headers"])
+                content_type = headers.get("content-type", "")
+                passthrough = "content-encoding" in headers or not content_type.startswith("application/json")
+                if passthrough:
+                    await send(start_message)
+                return
+
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            chunks.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+
+            body = b"".join(chunks)
+            headers = MutableHeaders(raw=start_message["headers"])
+            if len(body) >= self.minimum_size:
+                if encoding == "br":
+                    body = brotli.compress(body, quality=self.brotli_quality)
+                else:
+                    body = gzip.compress(body, compresslevel=self.gzip_level)
+                headers["Content-Encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+            headers["Content-Length"] = str(len(body))
+
+            await send(start_message)
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_wrapper)
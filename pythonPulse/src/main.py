@@ -1,80 +1,114 @@
 import discord
 from discord.ext import commands
-from config import DISCORD_TOKEN
+from config import (DISCORD_TOKEN, BOT_MAX_MESSAGES, SHARD_COUNT, SHARD_IDS,
+                    RUN_MODE, PORT, API_WORKERS, missing_settings)
 import asyncio
+import argparse
 import os
+import sys
+import time
+import requests
 import uvicorn
-from api import app as fastapi_app
 from plan_tiers import sync_plan_tiers
 from services.supabase_client import supabase
+from services.presence_sync import presence_buffer, known_users
+from services.guild_settings import guild_settings
+from services.cache_bus import cache_bus
+from services.message_claims import message_claims
+from services.duplicate_index import duplicate_index
 
 import subprocess
 
+def parse_shard_ids(value):
+    """'0-3' -> [0, 1, 2, 3]; '0,2,5' -> [0, 2, 5]"""
+    if not value:
+        return None
+    shard_ids = []
+    for part in str(value).split(","):
+        part = part.strip()
+        if "-" in part:
+            start, end = part.split("-", 1)
+            shard_ids.extend(range(int(start), int(end) + 1))
+        elif part:
+            shard_ids.append(int(part))
+    return sorted(set(shard_ids))
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="ProjectPulse Discord bot + API")
+    parser.add_argument("--mode", choices=["all", "bot", "api"], default=RUN_MODE,
+                        help="all: bot and API in one process; bot: Discord bot only; api: HTTP API only (default: $RUN_MODE or all)")
+    parser.add_argument("--api-workers", type=int, default=API_WORKERS,
+                        help="uvicorn worker processes in --mode api")
+    parser.add_argument("--shard-count", type=int, default=SHARD_COUNT,
+                        help="Total shards across all processes (default: Discord's recommendation)")
+    parser.add_argument("--shard-ids", type=parse_shard_ids, default=parse_shard_ids(SHARD_IDS),
+                        help="Shards this process runs, e.g. 0-3 or 0,1,2,3 (default: all)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Spread the shards over this many bot processes (launcher mode)")
+    parser.add_argument("--no-api", action="store_true",
+                        help="Same as --mode bot")
+    return parser
+
+# Only the real entry point reads CLI flags; importing this module just uses the env defaults
+args = build_parser().parse_args(None if __name__ == "__main__" else [])
+if args.no_api:
+    args.mode = "bot"
+if args.shard_ids and not args.shard_count:
+    build_parser().error("--shard-ids requires --shard-count")
+
 # Define Intents
 intents = discord.Intents.default()
 intents.message_content = True 
-intents.presences = True # Critical for status updates
+# Presences are a global gateway intent: in opt-in mode it is only requested once some guild has
+# opted in, and the per-guild filter is then applied in on_raw_presence_update
+intents.presences = args.mode != "api" and guild_settings.presence_intent_needed()
 
 # Initialize Bot
-bot = commands.Bot(command_prefix="!", intents=intents)
+# AutoSharded: one gateway connection per shard. Guild-level state (cog sessions, caches) lives in
+# this process, so each shard group owns the state for exactly the guilds on its shards.
+bot = commands.AutoShardedBot(
+    command_prefix="!",
+    intents=intents,
+    shard_count=args.shard_count,
+    shard_ids=args.shard_ids,
+    # Smaller than discord.py's default of 1000; nothing here reads old messages from the cache
+    max_messages=BOT_MAX_MESSAGES,
+    # Nothing here reads cached members (authors come with each message), so don't keep them
+    member_cache_flags=discord.MemberCacheFlags.none(),
+    # Don't request every guild's member list at startup; readiness no longer scales with member count
+    chunk_guilds_at_startup=False,
+    # Raw presence events don't need the member to be cached
+    enable_raw_presences=intents.presences,
+)
 
 @bot.event
-async def on_presence_update(before, after):
-    """Sync Discord status to Supabase profile"""
-    if after.bot:
+async def on_raw_presence_update(payload):
+    """Sync Discord status to Supabase profile (opted-in guilds only)"""
+    if not guild_settings.presence_enabled(payload.guild_id):
+        return
+
+    # Most members have no ProjectPulse profile (bots never do), drop them without a DB round trip
+    if payload.user_id not in known_users:
         return
         
     try:
-        # Map Discord status to a simple string
-        status = str(after.status)
-        
-        # Only update if status changed
-        if str(before.status) != status:
-            # Update profile where discord_user_id matches
-            # Note: We need to make sure we have discord_user_id in profiles. 
-            # Looking at schema, we don't explicitly see it, but on_guild_join uses it.
-            # wait, on_guild_join uses: .eq("discord_user_id", str(guild.owner_id))
-            # So discord_user_id MUST exist in profiles?
-            # Let's check schema.sql again.
-            # Schema.sql creates profiles table with: id, subscription_tier, status, discord_guild_id, trial_start... 
-            # It DOES NOT show `discord_user_id`.
-            # BUT main.py implies it exists: .eq("discord_user_id", str(guild.owner_id))
-            # If `discord_user_id` is missing in schema, it might have been added manually or main.py is failing?
-            # However, profiles.id IS the auth.users.id.
-            # If the user signed in with Discord, auth.users.id is NOT the discord ID.
-            # auth.users.id is a UUID.
-            
-            # If main.py assumes `discord_user_id` column exists, and it's working (or code is written that way),
-            # then we should trust the code or check if column exists.
-            
-            # We can't easily check columns without SQL. 
-            # Let's assume it exists or use a lookup.
-            pass
-            
-            # Actually, let's do the update assuming the column `discord_user_id` is there 
-            # OR we try to match by something else?
-            # If we don't have discord_user_id column, we can't link `after.id` to a profile easily
-            # UNLESS `discord_user_id` is stored.
-            
-            # Let's add the code with a check.
-            
-            # For now, let's just write the listener assuming best effort.
-            
-            # Wait, `on_guild_join` logic:
-            # .eq("discord_user_id", str(guild.owner_id))
-            # This strongly suggests the column exists.
-            
-            supabase.table("profiles").update({
-                "discord_status": status
-            }).eq("discord_user_id", str(after.id)).execute()
-            
+        # Buffered: flushed periodically as grouped updates matching profiles.discord_user_id
+        # (the column on_guild_join links owners with), so flapping collapses to one write
+        presence_buffer.record(payload.user_id, str(payload.status))
     except Exception as e:
         print(f"Error syncing presence: {e}")
 
 @bot.event
 async def on_ready():
     print(f'Logged in as {bot.user} (ID: {bot.user.id})')
+    print(f'Shards: {sorted(bot.shards)} of {bot.shard_count} ({len(bot.guilds)} guilds)')
     print('------')
+    guild_settings.start()
+    cache_bus.start()
+    message_claims.start()
+    if intents.presences:
+        known_users.start()
+        presence_buffer.start()
     
     # 1. Randomized delay to reduce race conditions in multi-bot setups
     await asyncio.sleep(os.getpid() % 3 + 1) # Simple way to stagger instances
@@ -135,6 +169,7 @@ async def on_guild_join(guild):
                 supabase.table("profiles").update({
                     "discord_guild_id": str(guild.id)
                 }).eq("discord_user_id", str(guild.owner_id)).execute()
+                known_users.add(guild.owner_id)
                 print(f"Automatically linked server to owner's profile: {profile.get('email')}")
             else:
                 print(f"Warning: Could not find profile for server owner (Discord ID: {guild.owner_id})")
@@ -163,42 +198,61 @@ async def load_extensions():
             print(f"Loaded extension: {filename}")
 
 
+# Settings edited elsewhere are reloaded right away (a guild_settings trigger publishes the change, see schema.sql)
+cache_bus.subscribe("guild_settings", lambda key: asyncio.create_task(asyncio.to_thread(guild_settings.load)))
+# A ticket opened by another instance becomes a duplicate candidate here too
+cache_bus.subscribe("tickets", duplicate_index.invalidate)
+
+
 async def run_fastapi():
-    port = int(os.getenv("PORT", 8000))
-    config = uvicorn.Config(fastapi_app, host="0.0.0.0", port=port, log_level="info")
+    # Imported here so bot-only processes don't load the API (and its Stripe/SMTP setup)
+    from api import app as fastapi_app
+    config = uvicorn.Config(fastapi_app, host="0.0.0.0", port=PORT, log_level="info")
     server = uvicorn.Server(config)
     await server.serve()
 
-async def main():
-    # Sync Stripe plan tiers at startup
+def run_api_only():
+    """API mode: uvicorn's own worker processes, each importing api:app. No Discord connection."""
     try:
         sync_plan_tiers()
     except Exception as e:
         print(f"Failed to sync plan tiers on startup: {e}")
+    print(f"Starting API only on port {PORT} with {args.api_workers} worker(s)")
+    uvicorn.run("api:app", host="0.0.0.0", port=PORT, workers=args.api_workers,
+                app_dir=os.path.dirname(os.path.abspath(__file__)), log_level="info")
 
-    # Auto-start Stripe Listener (Development Only)
-    if os.getenv("ENV") != "production":
+async def main():
+    # Process-wide startup work only runs once, in the process that serves the API
+    if args.mode == "all":
+        # Sync Stripe plan tiers at startup
         try:
-            print("Starting Stripe Listener (Background)...")
-            # Run stripe listen silently
-            subprocess.Popen(
-                ["stripe", "listen", "--forward-to", "localhost:8000/webhook"], 
-                shell=True,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL
-            )
+            sync_plan_tiers()
         except Exception as e:
-            print(f"Could not start Stripe Listener automatically: {e}")
-    else:
-        print("Running in Production Mode - Skipping local Stripe Listener")
+            print(f"Failed to sync plan tiers on startup: {e}")
+
+        # Auto-start Stripe Listener (Development Only)
+        if os.getenv("ENV") != "production":
+            try:
+                print("Starting Stripe Listener (Background)...")
+                # Run stripe listen silently
+                subprocess.Popen(
+                    ["stripe", "listen", "--forward-to", "localhost:8000/webhook"], 
+                    shell=True,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL
+                )
+            except Exception as e:
+                print(f"Could not start Stripe Listener automatically: {e}")
+        else:
+            print("Running in Production Mode - Skipping local Stripe Listener")
     
-    # Run both bot and API
+    # Run the bot, plus the API in combined mode
+    tasks = [load_extensions(), bot.start(DISCORD_TOKEN)]
+    if args.mode == "all":
+        tasks.append(run_fastapi())
+
     try:
-        await asyncio.gather(
-            load_extensions(),
-            bot.start(DISCORD_TOKEN),
-            run_fastapi()
-        )
+        await asyncio.gather(*tasks)
     except Exception as e:
         if "429" in str(e):
             print("\nCRITICAL ERROR: Discord Rate Limit (429) hit.")
@@ -208,17 +262,105 @@ async def main():
             print(f"Main Loop error: {e}")
     finally:
         print("Shutting down bot...")
+        await presence_buffer.flush()
         if not bot.is_closed():
             await bot.close()
 
 
+def recommended_shard_count():
+    """Asks Discord how many shards this bot should use."""
+    response = requests.get(
+        "https://discord.com/api/v10/gateway/bot",
+        headers={"Authorization": f"Bot {DISCORD_TOKEN}"},
+        timeout=10
+    )
+    response.raise_for_status()
+    return response.json()["shards"]
+
+def split_shards(shard_count, workers):
+    """Contiguous shard ranges, one per worker: split_shards(8, 3) -> [[0, 1, 2], [3, 4, 5], [6, 7]]"""
+    workers = max(1, min(workers, shard_count))
+    size, extra = divmod(shard_count, workers)
+    ranges, start = [], 0
+    for i in range(workers):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+# Worker restarts back off exponentially from the first delay up to the cap
+WORKER_RESTART_DELAY_SECONDS = 5
+WORKER_RESTART_MAX_DELAY_SECONDS = 300
+# A worker that ran at least this long counts as healthy again (backoff resets)
+WORKER_STABLE_SECONDS = 120
+# A worker that crashes this many times in a row without becoming healthy is not restarted
+WORKER_MAX_FAST_CRASHES = 5
+
+def run_workers():
+    """
+    Launcher mode: one bot process per shard range, restarted with backoff if it exits.
+    Only the first serves the API (in --mode all).
+    """
+    shard_count = args.shard_count or recommended_shard_count()
+    ranges = split_shards(shard_count, args.workers)
+    print(f"Launching {len(ranges)} bot workers for {shard_count} shards: {ranges}")
+
+    def spawn(index):
+        cmd = [sys.executable, os.path.abspath(__file__),
+               "--shard-count", str(shard_count),
+               "--shard-ids", ",".join(str(i) for i in ranges[index])]
+        cmd += ["--mode", "all" if index == 0 and args.mode == "all" else "bot"]
+        return subprocess.Popen(cmd)
+
+    processes = [spawn(i) for i in range(len(ranges))]
+    started = [time.monotonic()] * len(ranges)
+    crashes = [0] * len(ranges)
+    restart_at = [None] * len(ranges)
+    try:
+        while True:
+            time.sleep(1)
+            now = time.monotonic()
+            for i, process in enumerate(processes):
+                if process is None:
+                    continue
+                if restart_at[i] is not None:
+                    if now >= restart_at[i]:
+                        restart_at[i] = None
+                        started[i] = now
+                        processes[i] = spawn(i)
+                    continue
+                if process.poll() is None:
+                    continue
+
+                crashes[i] = 1 if now - started[i] >= WORKER_STABLE_SECONDS else crashes[i] + 1
+                if crashes[i] >= WORKER_MAX_FAST_CRASHES:
+                    print(f"Worker {i} (shards {ranges[i]}) crashed {WORKER_MAX_FAST_CRASHES} times in a row, giving up on it")
+                    processes[i] = None
+                    continue
+                delay = min(WORKER_RESTART_DELAY_SECONDS * 2 ** (crashes[i] - 1), WORKER_RESTART_MAX_DELAY_SECONDS)
+                print(f"Worker {i} (shards {ranges[i]}) exited with {process.returncode}, restarting in {delay}s...")
+                restart_at[i] = now + delay
+            if all(process is None for process in processes):
+                print("Every bot worker has given up, exiting")
+                sys.exit(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            if process is not None and process.poll() is None:
+                process.terminate()
 
 
 if __name__ == "__main__":
-    if not DISCORD_TOKEN:
-        print("Error: DISCORD_TOKEN not found in .env")
+    missing = missing_settings(args.mode)
+    if missing:
+        print(f"Error: missing settings for --mode {args.mode}: {', '.join(missing)} (check your .env)")
+    elif args.mode == "api":
+        run_api_only()
+    elif args.workers > 1:
+        run_workers()
     else:
         try:
             asyncio.run(main())
         except KeyboardInterrupt:
-            pass
\ No newline at end of file
+            pass
@@ -0,0 +1,94 @@
+import asyncio
+from config import INSTANCE_ID
+
+# Seconds between polls for invalidations published by other processes
+CACHE_BUS_POLL_SECONDS = 5
+# Rows older than this are pruned; a process that was down longer reloads its caches anyway
+CACHE_BUS_RETENTION_MINUTES = 60
+
+
+class CacheBus:
+    """
+    Cross-process cache invalidation over the cache_invalidations table.
+
+    publish(topic, key) runs local handlers immediately and records the event; every other
+    process (API workers, bot shards) picks it up on its next poll and runs its handlers.
+    Handlers are plain callables taking the key (None means "everything in this topic").
+    """
+
+    def __init__(self, poll_seconds=CACHE_BUS_POLL_SECONDS):
+        self.poll_seconds = poll_seconds
+        self.handlers = {}
+        self.last_id = None
+        self.task = None
+
+    def subscribe(self, topic, handler):
+        self.handlers.setdefault(topic, []).append(handler)
+
+    def _dispatch(self, topic, key):
+        for handler in self.handlers.get(topic, []):
+            try:
+                handler(key)
+            except Exception as e:
+                print(f"Cache invalidation handler for {topic} failed: {e}", flush=True)
+
+    def publish(self, topic, key=None, local=True):
+        """
+        Invalidates locally and tells the other processes. Blocking (one insert); never raises.
+        local=False only tells the others, for callers that already updated their own cache.
+        """
+        if local:
+            self._dispatch(topic, key)
+        try:
+            from services.supabase_client import supabase
+            supabase.table("cache_invalidations").insert({
+                "topic": topic,
+                "key": None if key is None else str(key),
+                "origin": INSTANCE_ID
+            }).execute()
+        except Exception as e:
+            print(f"Warning: Failed to publish cache invalidation {topic}: {e}", flush=True)
+
+    def _poll(self):
+        from services.supabase_client import supabase
+        if self.last_id is None:
+            # Start from the newest row; anything older predates our caches
+            res = supabase.table("cache_invalidations").select("id").order("id", desc=True).limit(1).execute()
+            self.last_id = res.data[0]["id"] if res.data else 0
+            return []
+        res = supabase.table("cache_invalidations")\
+            .select("id, topic, key, origin")\
+            .gt("id", self.last_id)\
+            .order("id")\
+            .limit(500)\
+            .execute()
+        rows = res.data or []
+        if rows:
+            self.last_id = rows[-1]["id"]
+        return [r for r in rows if r.get("origin") != INSTANCE_ID]
+
+    def _prune(self):
+        from datetime import datetime, timedelta, timezone
+        from services.supabase_client import supabase
+        cutoff = (datetime.now(timezone.utc) - timedelta(minutes=CACHE_BUS_RETENTION_MINUTES)).isoformat()
+        supabase.table("cache_invalidations").delete().lt("created_at", cutoff).execute()
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        polls = 0
+        while True:
+            try:
+                for row in await asyncio.to_thread(self._poll):
+                    self._dispatch(row["topic"], row.get("key"))
+                polls += 1
+                if polls % max(1, int(CACHE_BUS_RETENTION_MINUTES * 60 / self.poll_seconds)) == 0:
+                    await asyncio.to_thread(self._prune)
+            except Exception as e:
+                print(f"Cache bus poll failed: {e}", flush=True)
+            await asyncio.sleep(self.poll_seconds)
+
+
+cache_bus = CacheBus()
@@ -0,0 +1,59 @@
+import time
+import threading
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency that is currently failing."""
+
+
+class CircuitBreaker:
+    """
+    Closed: calls go through, consecutive failures are counted. After `failures` in a row
+    it opens and every call fails fast with CircuitOpenError for `cooldown_seconds`. Then
+    it is half-open: a single trial call goes through, closing the breaker on success or
+    opening it again on failure. Thread-safe, since Cohere calls run in worker threads.
+    """
+
+    def __init__(self, name, failures=5, cooldown_seconds=30.0):
+        self.name = name
+        self.failure_threshold = failures
+        self.cooldown_seconds = cooldown_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown_seconds:
+            return "open"
+        return "half-open"
+
+    def before_call(self):
+        """Raises CircuitOpenError if the call shouldn't be made right now."""
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return
+            if state == "half-open" and not self.trial_running:
+                self.trial_running = True
+                return
+        raise CircuitOpenError(f"{self.name} circuit is open")
+
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                print(f"BREAKER: {self.name} closed again", flush=True)
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or (self.opened_at is None and self.failures >= self.failure_threshold):
+                print(f"BREAKER: {self.name} open for {self.cooldown_seconds:.0f}s after {self.failures} failures", flush=True)
+                self.opened_at = time.monotonic()
+            self.trial_running = False
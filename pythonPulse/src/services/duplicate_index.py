@@ -0,0 +1,127 @@
+import re
+import time
+import asyncio
+import hashlib
+from datetime import datetime, timedelta, timezone
+from services.supabase_client import supabase
+
+# Open tickets younger than this are candidates for duplicates
+DUPLICATE_WINDOW_HOURS = 24
+# Estimated Jaccard similarity (over words and word pairs) needed to call a report a repeat
+DUPLICATE_THRESHOLD = 0.4
+# Messages with fewer distinct words are too vague to match ("help", "is it down?")
+DUPLICATE_MIN_TOKENS = 3
+# A guild's index is reloaded from the tickets table after this many seconds
+DUPLICATE_INDEX_TTL_SECONDS = 300
+MINHASH_PERMUTATIONS = 64
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+# Fixed (a, b) pairs so signatures are comparable across restarts and instances
+_PERMUTATIONS = [
+    (int.from_bytes(hashlib.blake2b(f"a{i}".encode(), digest_size=8).digest(), "big") % (_MERSENNE_PRIME - 1) + 1,
+     int.from_bytes(hashlib.blake2b(f"b{i}".encode(), digest_size=8).digest(), "big") % _MERSENNE_PRIME)
+    for i in range(MINHASH_PERMUTATIONS)
+]
+
+STOPWORDS = {
+    "a", "an", "the", "is", "are", "was", "were", "be", "been", "it", "its", "this", "that",
+    "to", "of", "in", "on", "for", "and", "or", "but", "with", "at", "by", "from", "my", "me",
+    "i", "im", "we", "you", "your", "our", "they", "so", "just", "can", "cant", "not", "no",
+    "do", "does", "dont", "doesnt", "again", "any", "anyone", "else", "also", "still", "please", "pls"
+}
+
+
+def tokenize(text):
+    words = [w for w in re.findall(r"[a-z0-9]+", (text or "").lower().replace("'", "")) if w not in STOPWORDS]
+    # Word pairs keep some order ("cant login" vs "login page") without making short texts unmatchable
+    return set(words) | {f"{a} {b}" for a, b in zip(words, words[1:])}
+
+
+def minhash(tokens):
+    hashes = [int.from_bytes(hashlib.blake2b(t.encode(), digest_size=8).digest(), "big") for t in tokens]
+    return tuple(min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes) for a, b in _PERMUTATIONS)
+
+
+def similarity(sig_a, sig_b):
+    """Estimated Jaccard similarity of the token sets behind two signatures."""
+    return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / len(sig_a)
+
+
+class DuplicateIndex:
+    """
+    Per-guild MinHash index over recent open tickets, used to recognise repeat reports of
+    the same problem (an outage brings in dozens of "login is broken") before they reach the LLM.
+
+    Each guild's index is loaded lazily from the tickets table, reloaded every
+    DUPLICATE_INDEX_TTL_SECONDS and extended with add() as tickets are created.
+    """
+
+    def __init__(self):
+        # guild_id -> {"loaded_at": float, "tickets": {ticket_id: signature}}
+        self.guilds = {}
+
+    def _fetch(self, guild_id):
+        """Blocking: signatures of the guild's recent open tickets."""
+        cutoff = (datetime.now(timezone.utc) - timedelta(hours=DUPLICATE_WINDOW_HOURS)).isoformat()
+        res = supabase.table("tickets")\
+            .select("id, title, description")\
+            .eq("discord_guild_id", str(guild_id))\
+            .eq("status", "open")\
+            .gte("created_at", cutoff)\
+            .order("created_at", desc=True)\
+            .limit(500)\
+            .execute()
+        tickets = {}
+        for row in res.data or []:
+            # The description starts with the original report; any follow-up comes after it
+            text = (row.get("description") or "").split("\n\nFOLLOW-UP:")[0]
+            tokens = tokenize(text)
+            if len(tokens) >= DUPLICATE_MIN_TOKENS:
+                tickets[row["id"]] = minhash(tokens)
+        return tickets
+
+    def _closest(self, signature, candidates):
+        best = None
+        for ticket_id, ticket_signature in candidates:
+            score = similarity(signature, ticket_signature)
+            if score >= DUPLICATE_THRESHOLD and (best is None or score > best[1]):
+                best = (ticket_id, score)
+        return best
+
+    async def find(self, guild_id, text):
+        """
+        Returns (ticket_id, similarity) of the closest open ticket above the threshold, or None.
+        The index itself is only read and written here on the event loop (like add() and
+        invalidate()); the Supabase load and the comparisons run in worker threads.
+        """
+        tokens = tokenize(text)
+        if len(tokens) < DUPLICATE_MIN_TOKENS:
+            return None
+        try:
+            entry = self.guilds.get(str(guild_id))
+            if not entry or time.time() - entry["loaded_at"] > DUPLICATE_INDEX_TTL_SECONDS:
+                tickets = await asyncio.to_thread(self._fetch, guild_id)
+                entry = self.guilds[str(guild_id)] = {"loaded_at": time.time(), "tickets": tickets}
+            # Snapshot, so an add() meanwhile doesn't change the dict under the worker thread
+            candidates = list(entry["tickets"].items())
+            return await asyncio.to_thread(self._closest, minhash(tokens), candidates)
+        except Exception as e:
+            print(f"Error checking for duplicate reports: {e}")
+            return None
+
+    def add(self, guild_id, ticket_id, text):
+        entry = self.guilds.get(str(guild_id))
+        tokens = tokenize(text)
+        # Not loaded yet: the next lookup loads it, ticket included
+        if entry and ticket_id and len(tokens) >= DUPLICATE_MIN_TOKENS:
+            entry["tickets"][ticket_id] = minhash(tokens)
+
+    def invalidate(self, guild_id=None):
+        if guild_id is None:
+            self.guilds.clear()
+        else:
+            self.guilds.pop(str(guild_id), None)
+
+
+duplicate_index = DuplicateIndex()
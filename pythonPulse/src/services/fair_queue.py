@@ -0,0 +1,107 @@
+import heapq
+import asyncio
+import itertools
+from collections import deque
+
+
+class DeficitRoundRobin:
+    """
+    Per-tenant FIFO queues served by deficit round-robin: on each visit a tenant's deficit
+    grows by quantum * weight and it is served while the deficit covers the next item's cost
+    (1 per item), then the next tenant gets its turn. A tenant with weight 2 gets twice the
+    share of one with weight 1, and a quiet tenant never waits behind a noisy tenant's backlog.
+    """
+
+    def __init__(self, quantum=1.0):
+        self.quantum = quantum
+        self.queues = {}
+        self.weights = {}
+        self.deficits = {}
+        self.active = deque()
+        self.visiting = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, key, item, weight=1):
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = self._new_queue()
+            self.deficits[key] = 0.0
+            self.active.append(key)
+        self.weights[key] = max(weight, 0.01)
+        self._queue_push(queue, item)
+        self.size += 1
+
+    def pop(self):
+        while True:
+            key = self.active[0]
+            if self.visiting != key:
+                # Start of this tenant's turn
+                self.visiting = key
+                self.deficits[key] += self.quantum * self.weights[key]
+            if self.deficits[key] >= 1:
+                self.deficits[key] -= 1
+                queue = self.queues[key]
+                item = self._queue_pop(queue)
+                self.size -= 1
+                if not queue:
+                    # Idle tenants don't bank credit
+                    self.active.popleft()
+                    del self.queues[key], self.deficits[key], self.weights[key]
+                    self.visiting = None
+                return item
+            self.visiting = None
+            self.active.rotate(-1)
+
+    # Per-tenant ordering, FIFO by default
+    def _new_queue(self):
+        return deque()
+
+    def _queue_push(self, queue, item):
+        queue.append(item)
+
+    def _queue_pop(self, queue):
+        return queue.popleft()
+
+
+class PriorityDeficitRoundRobin(DeficitRoundRobin):
+    """DeficitRoundRobin whose per-tenant queues hand out the highest priority(item) first (ties: FIFO)."""
+
+    def __init__(self, priority, quantum=1.0):
+        super().__init__(quantum)
+        self.priority = priority
+        self.counter = itertools.count()
+
+    def _new_queue(self):
+        return []
+
+    def _queue_push(self, queue, item):
+        heapq.heappush(queue, (-self.priority(item), next(self.counter), item))
+
+    def _queue_pop(self, queue):
+        return heapq.heappop(queue)[2]
+
+
+class FairQueue(asyncio.Queue):
+    """
+    asyncio.Queue whose get() order is fair across tenants (deficit round-robin), e.g. guilds
+    sharing the LLM workers. key(item) names the tenant, weight(item) its share and, if given,
+    priority(item) orders each tenant's own items (highest first).
+    """
+
+    def __init__(self, maxsize=0, key=None, weight=None, priority=None):
+        self._key = key or (lambda item: None)
+        self._weight = weight or (lambda item: 1)
+        self._scheduler = PriorityDeficitRoundRobin(priority) if priority else DeficitRoundRobin()
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        self._queue = self._scheduler
+
+    def _put(self, item):
+        self._queue.push(self._key(item), item, self._weight(item))
+
+    def _get(self):
+        return self._queue.pop()
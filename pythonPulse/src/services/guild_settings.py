@@ -0,0 +1,80 @@
+import asyncio
+from services.supabase_client import supabase
+from config import PRESENCE_TRACKING, PRESENCE_GUILD_IDS, DAILY_PULSE_TIMEZONE, DAILY_PULSE_HOUR
+
+# Seconds between reloads of the guild_settings table
+GUILD_SETTINGS_REFRESH_SECONDS = 300
+
+DEFAULT_GUILD_SETTINGS = {
+    "presence_tracking": False,
+    "timezone": DAILY_PULSE_TIMEZONE,
+    "summary_hour": DAILY_PULSE_HOUR,
+}
+
+
+class GuildSettings:
+    """Per-guild bot configuration (guild_settings table), cached in memory and reloaded periodically."""
+
+    def __init__(self):
+        self.settings = {}
+        self.task = None
+        self.loaded = asyncio.Event()
+
+    def get(self, guild_id):
+        row = self.settings.get(str(guild_id), {})
+        # Unset (null) columns fall back to the defaults
+        return {**DEFAULT_GUILD_SETTINGS, **{k: v for k, v in row.items() if v is not None}}
+
+    def presence_enabled(self, guild_id):
+        if PRESENCE_TRACKING == "all":
+            return True
+        if PRESENCE_TRACKING == "off" or guild_id is None:
+            return False
+        return str(guild_id) in PRESENCE_GUILD_IDS or bool(self.get(guild_id).get("presence_tracking"))
+
+    def presence_intent_needed(self):
+        """
+        Blocking: whether to subscribe to the (global) presences intent at all. In opt-in mode
+        that's only worth it once some guild has opted in; the intent is fixed when the gateway
+        connects, so a guild opting in later takes effect on the next restart.
+        """
+        if PRESENCE_TRACKING != "opt-in":
+            return PRESENCE_TRACKING == "all"
+        if PRESENCE_GUILD_IDS:
+            return True
+        try:
+            res = supabase.table("guild_settings")\
+                .select("guild_id")\
+                .eq("presence_tracking", True)\
+                .limit(1)\
+                .execute()
+            return bool(res.data)
+        except Exception as e:
+            # Can't tell, so keep presences rather than silently stop syncing opted-in guilds
+            print(f"Warning: Failed to check presence opt-ins, enabling the presences intent: {e}")
+            return True
+
+    def load(self):
+        """Blocking reload of every guild's settings."""
+        res = supabase.table("guild_settings").select("*").execute()
+        self.settings = {str(row["guild_id"]): row for row in (res.data or [])}
+
+    async def wait_loaded(self):
+        """Returns once the table has been loaded at least once."""
+        await self.loaded.wait()
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.load)
+                self.loaded.set()
+            except Exception as e:
+                print(f"Error loading guild settings: {e}")
+            await asyncio.sleep(GUILD_SETTINGS_REFRESH_SECONDS)
+
+
+guild_settings = GuildSettings()
@@ -0,0 +1,99 @@
+import time
+import asyncio
+from datetime import datetime, timedelta, timezone
+from config import INSTANCE_ID
+
+# A leader that stops renewing loses the lease after this many seconds
+LEASE_TTL_SECONDS = 60
+# Renewal (and follower retry) interval; several renewals fit in one TTL
+LEASE_RENEW_SECONDS = 20
+
+
+def _timestamp(dt):
+    # "Z" rather than "+00:00": a literal "+" would need escaping inside the PostgREST or=() filter
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+class LeaderLease:
+    """
+    Leader election over a row in the leases table, so scheduled jobs run in one
+    instance only. The holder renews the lease every LEASE_RENEW_SECONDS; the others
+    retry at the same pace and take over once it has expired (leader died or hung).
+
+    is_leader also checks a local deadline, so a leader that can't reach Supabase
+    stops acting before its lease can pass to someone else. Expiry is compared on
+    the instances' clocks, keep the TTL well above any expected clock skew.
+    """
+
+    def __init__(self, name, ttl_seconds=LEASE_TTL_SECONDS, renew_seconds=LEASE_RENEW_SECONDS):
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.renew_seconds = renew_seconds
+        self.held_until = 0.0
+        self.task = None
+
+    @property
+    def is_leader(self):
+        return time.monotonic() < self.held_until
+
+    def try_acquire(self):
+        """Blocking: takes or renews the lease. Returns True if this instance holds it."""
+        from services.supabase_client import supabase
+        started = time.monotonic()
+        now = datetime.now(timezone.utc)
+        row = {
+            "holder": INSTANCE_ID,
+            "expires_at": _timestamp(now + timedelta(seconds=self.ttl_seconds))
+        }
+        # Renew our own lease or take over an expired one, in a single conditional UPDATE
+        res = supabase.table("leases").update(row)\
+            .eq("name", self.name)\
+            .or_(f'holder.eq."{INSTANCE_ID}",expires_at.lt.{_timestamp(now)}')\
+            .execute()
+        acquired = bool(res.data)
+        if not acquired:
+            # First run for this lease name: insert-if-absent, exactly one instance gets the row
+            res = supabase.table("leases").upsert(
+                {"name": self.name, **row}, on_conflict="name", ignore_duplicates=True
+            ).execute()
+            acquired = bool(res.data)
+
+        was_leader = self.is_leader
+        # Measured from before the request, so the local deadline never outlives the stored one
+        self.held_until = started + self.ttl_seconds if acquired else 0.0
+        if acquired and not was_leader:
+            print(f"LEASE: {INSTANCE_ID} is now leader for {self.name}", flush=True)
+        elif was_leader and not acquired:
+            print(f"LEASE: {INSTANCE_ID} lost leadership for {self.name}", flush=True)
+        return acquired
+
+    def release(self):
+        """Blocking: gives the lease up so another instance can take over immediately."""
+        from services.supabase_client import supabase
+        self.held_until = 0.0
+        supabase.table("leases").update({
+            "expires_at": _timestamp(datetime.now(timezone.utc))
+        }).eq("name", self.name).eq("holder", INSTANCE_ID).execute()
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        if self.is_leader:
+            try:
+                await asyncio.to_thread(self.release)
+            except Exception as e:
+                print(f"Error releasing lease {self.name}: {e}")
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.try_acquire)
+            except Exception as e:
+                # Keep the local deadline: we stay leader until it passes, then stop acting
+                print(f"Error renewing lease {self.name}: {e}")
+            await asyncio.sleep(self.renew_seconds)
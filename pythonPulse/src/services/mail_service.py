@@ -0,0 +1,249 @@
+import os
+import html
+import time
+import uuid
+import asyncio
+import smtplib
+from string import Template
+from collections import OrderedDict
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+
+# SMTP settings. For local testing point these at a stand-in server, e.g.
+#   python -m aiosmtpd -n -l localhost:1025
+#   SMTP_SERVER=localhost SMTP_PORT=1025 SMTP_STARTTLS=false
+SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "true").lower() != "false"
+SENDER_EMAIL = os.getenv("EMAIL_USER")
+SENDER_PASSWORD = os.getenv("EMAIL_PASSWORD")
+
+# Messages sent over one authenticated session before reconnecting (Gmail caps ~100 per connection)
+MESSAGES_PER_CONNECTION = int(os.getenv("SMTP_MESSAGES_PER_CONNECTION", 50))
+# Idle sessions are closed after this many seconds
+CONNECTION_IDLE_SECONDS = int(os.getenv("SMTP_IDLE_SECONDS", 30))
+MAIL_WORKERS = int(os.getenv("MAIL_WORKERS", 2))
+# Messages a worker takes off the queue per SMTP round
+BATCH_SIZE = 20
+# Delivery reports kept in memory for GET /invites/{batch_id}; they're also stored in the
+# invite_results table, so a batch can be looked up from any API worker
+MAX_TRACKED_BATCHES = 500
+
+# Compiled once at import instead of re-formatting an f-string per message
+INVITE_SUBJECT = "You've been invited to join the team on Project Pulse!"
+INVITE_TEMPLATE = Template("""
+        <div style="font-family: sans-serif; max-width: 600px; margin: 0 auto;">
+            <h1 style="color: #4F46E5;">Welcome to the Team!</h1>
+            <p>You've been invited to join Project Pulse as a <strong>$role</strong>.</p>
+            <p>Click the button below to accept your invitation and get started.</p>
+            <a href="$invite_link" style="display: inline-block; background-color: #4F46E5; color: white; padding: 12px 24px; text-decoration: none; border-radius: 6px; font-weight: bold; margin-top: 16px;">Accept Invitation</a>
+            <p style="margin-top: 24px; color: #666; font-size: 12px;">If you were not expecting this invite, please ignore this email.</p>
+        </div>
+        """)
+
+
+def is_configured():
+    return bool(SENDER_EMAIL)
+
+
+def build_invite_message(email, role):
+    frontend_url = os.getenv('FRONTEND_URL', 'http://localhost:3000')
+    invite_link = f"{frontend_url}/signup?email={email}"
+
+    msg = MIMEMultipart()
+    msg['From'] = f"Project Pulse <{SENDER_EMAIL}>"
+    msg['To'] = email
+    msg['Subject'] = INVITE_SUBJECT
+    html_content = INVITE_TEMPLATE.substitute(
+        role=html.escape(str(role)),
+        invite_link=html.escape(invite_link, quote=True)
+    )
+    msg.attach(MIMEText(html_content, 'html'))
+    return msg
+
+
+class MailJob:
+    def __init__(self, batch_id, email, message, position=0):
+        self.batch_id = batch_id
+        self.email = email
+        self.position = position
+        self.message = message
+        self.future = asyncio.get_running_loop().create_future()
+        # Bulk jobs are never awaited, don't warn about unretrieved failures (they're in the batch report)
+        self.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+
+class MailQueue:
+    """
+    Background mail queue. Each worker owns one authenticated SMTP session and sends
+    up to BATCH_SIZE queued messages per round over it, reconnecting after
+    MESSAGES_PER_CONNECTION messages, when idle, or when the server drops the session.
+    """
+
+    def __init__(self, workers=MAIL_WORKERS, smtp_factory=None):
+        self.workers = workers
+        self.smtp_factory = smtp_factory or self._connect
+        self.queue = None
+        self.tasks = []
+        self.batches = OrderedDict()
+
+    def _ensure_started(self):
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        self.tasks = [t for t in self.tasks if not t.done()]
+        for i in range(len(self.tasks), self.workers):
+            self.tasks.append(asyncio.create_task(self._worker(i)))
+
+    def _connect(self):
+        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=30)
+        if SMTP_STARTTLS:
+            server.starttls()
+        if SENDER_PASSWORD:
+            server.login(SENDER_EMAIL, SENDER_PASSWORD)
+        return server
+
+    def enqueue_invites(self, invites):
+        """Queues [{'email', 'role'}]. Returns (batch_id, [MailJob])."""
+        self._ensure_started()
+        batch_id = uuid.uuid4().hex
+        report = {"created_at": time.time(), "results": OrderedDict()}
+        jobs = []
+        for invite in invites:
+            email = invite["email"]
+            report["results"][email] = "queued"
+            job = MailJob(batch_id, email, build_invite_message(email, invite.get("role")), len(jobs))
+            jobs.append(job)
+            self.queue.put_nowait(job)
+
+        self.batches[batch_id] = report
+        while len(self.batches) > MAX_TRACKED_BATCHES:
+            self.batches.popitem(last=False)
+        # Insert-if-absent, so it can't overwrite a result that got stored first
+        rows = [{"batch_id": batch_id, "email": job.email, "position": job.position, "status": "queued"}
+                for job in jobs]
+        asyncio.create_task(asyncio.to_thread(self._store_results, rows, True))
+        return batch_id, jobs
+
+    def _store_results(self, rows, only_new=False):
+        """Blocking: writes delivery statuses to invite_results. Never raises."""
+        # One row per address: an upsert can't touch the same row twice
+        rows = list({(row["batch_id"], row["email"]): row for row in rows}.values())
+        try:
+            from services.supabase_client import supabase
+            supabase.table("invite_results").upsert(
+                rows, on_conflict="batch_id,email", ignore_duplicates=only_new
+            ).execute()
+        except Exception as e:
+            print(f"Warning: Failed to store invite results: {e}", flush=True)
+
+    def _load_results(self, batch_id):
+        from services.supabase_client import supabase
+        res = supabase.table("invite_results")\
+            .select("email, status")\
+            .eq("batch_id", batch_id)\
+            .order("position")\
+            .execute()
+        return OrderedDict((row["email"], row["status"]) for row in (res.data or []))
+
+    def batch_status(self, batch_id):
+        """Blocking when the batch was queued by another worker (it's read from Supabase)."""
+        report = self.batches.get(batch_id)
+        if report:
+            results = report["results"]
+        else:
+            try:
+                results = self._load_results(batch_id)
+            except Exception as e:
+                print(f"Warning: Failed to load invite batch {batch_id}: {e}", flush=True)
+                results = None
+            if not results:
+                return None
+        counts = {}
+        for status in results.values():
+            key = "failed" if status.startswith("failed") else status
+            counts[key] = counts.get(key, 0) + 1
+        return {"batch_id": batch_id, "counts": counts, "results": dict(results)}
+
+    def _record(self, job, status):
+        report = self.batches.get(job.batch_id)
+        if report:
+            report["results"][job.email] = status
+
+    async def _worker(self, worker_id):
+        session = {"server": None, "sent": 0, "last_used": 0.0}
+        while True:
+            if session["server"]:
+                try:
+                    first = await asyncio.wait_for(self.queue.get(), timeout=CONNECTION_IDLE_SECONDS)
+                except asyncio.TimeoutError:
+                    # Nothing arrived while the session was open, release it
+                    await asyncio.to_thread(self._close, session)
+                    continue
+            else:
+                first = await self.queue.get()
+            jobs = [first]
+            while len(jobs) < BATCH_SIZE and not self.queue.empty():
+                jobs.append(self.queue.get_nowait())
+
+            # The SMTP conversation is blocking, run the whole round in a thread
+            results = await asyncio.to_thread(self._send_round, session, jobs)
+
+            stored = []
+            for job, error in zip(jobs, results):
+                stored.append({"batch_id": job.batch_id, "email": job.email, "position": job.position,
+                               "status": f"failed: {error}" if error else "sent"})
+                if error:
+                    print(f"EMAIL ERROR: Invite to {job.email} failed: {error}", flush=True)
+                    self._record(job, f"failed: {error}")
+                    if not job.future.done():
+                        job.future.set_exception(RuntimeError(error))
+                else:
+                    print(f"EMAIL (SMTP): Invite sent to {job.email}", flush=True)
+                    self._record(job, "sent")
+                    if not job.future.done():
+                        job.future.set_result(True)
+                self.queue.task_done()
+            await asyncio.to_thread(self._store_results, stored)
+
+    def _close(self, session):
+        server = session["server"]
+        session["server"] = None
+        session["sent"] = 0
+        if server:
+            try:
+                server.quit()
+            except Exception:
+                pass
+
+    def _send_round(self, session, jobs):
+        """Sends jobs over the worker's session. Returns an error string (or None) per job."""
+        results = []
+        for job in jobs:
+            error = None
+            for attempt in range(2):
+                try:
+                    if session["server"] and (session["sent"] >= MESSAGES_PER_CONNECTION
+                                              or time.monotonic() - session["last_used"] >= CONNECTION_IDLE_SECONDS):
+                        self._close(session)
+                    if not session["server"]:
+                        session["server"] = self.smtp_factory()
+                    session["server"].send_message(job.message)
+                    session["sent"] += 1
+                    session["last_used"] = time.monotonic()
+                    error = None
+                    break
+                except smtplib.SMTPServerDisconnected as e:
+                    # Stale session: reconnect once and retry this message
+                    session["server"] = None
+                    session["sent"] = 0
+                    error = str(e) or "Server disconnected"
+                except Exception as e:
+                    error = str(e)
+                    if not isinstance(e, smtplib.SMTPRecipientsRefused):
+                        self._close(session)
+                    break
+            results.append(error)
+        return results
+
+
+mail_queue = MailQueue()
@@ -0,0 +1,87 @@
+import asyncio
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from config import INSTANCE_ID, MESSAGE_CLAIMS
+
+# Claims older than this are deleted; Discord never redelivers a message that late
+CLAIM_RETENTION_HOURS = 24
+CLAIM_PRUNE_SECONDS = 3600
+# Message IDs remembered locally (duplicate deliveries within this process, DB outages)
+LOCAL_CLAIM_CACHE_SIZE = 10000
+
+
+class MessageClaims:
+    """
+    Makes sure only one bot instance triages a given Discord message.
+
+    Every instance running the same token receives the same gateway events, so before
+    any LLM or ticket work the handler calls claim(message_id): the first instance to
+    insert the row into message_claims wins, the others see the conflict and skip.
+    With MESSAGE_CLAIMS=local (single instance) or while Supabase is unreachable, an
+    in-process set stands in, so a DB outage degrades to the old duplicate behaviour
+    rather than dropping reports.
+    """
+
+    def __init__(self, backend=MESSAGE_CLAIMS):
+        self.backend = backend
+        self.local = OrderedDict()
+        self.task = None
+
+    def _claim_local(self, key):
+        if key in self.local:
+            return False
+        self.local[key] = True
+        while len(self.local) > LOCAL_CLAIM_CACHE_SIZE:
+            self.local.popitem(last=False)
+        return True
+
+    def _claim_remote(self, key):
+        from services.supabase_client import supabase
+        # Insert-if-absent: ON CONFLICT DO NOTHING returns no row when another instance got there first
+        res = supabase.table("message_claims").upsert({
+            "message_id": key,
+            "instance_id": INSTANCE_ID
+        }, on_conflict="message_id", ignore_duplicates=True).execute()
+        return bool(res.data)
+
+    def claim_blocking(self, message_id, kind="triage"):
+        key = f"{kind}:{message_id}"
+        if not self._claim_local(key):
+            return False
+        if self.backend == "local":
+            return True
+        try:
+            won = self._claim_remote(key)
+        except Exception as e:
+            print(f"Warning: Message claim failed for {key}, handling locally: {e}")
+            return True
+        if not won:
+            print(f"DEBUG: Message {key} claimed by another instance, skipping")
+        return won
+
+    async def claim(self, message_id, kind="triage"):
+        """True if this instance should handle the message (kind separates independent handlers)."""
+        return await asyncio.to_thread(self.claim_blocking, message_id, kind)
+
+    def prune(self):
+        """Blocking delete of expired claims."""
+        from services.supabase_client import supabase
+        cutoff = (datetime.now(timezone.utc) - timedelta(hours=CLAIM_RETENTION_HOURS)).isoformat()
+        supabase.table("message_claims").delete().lt("claimed_at", cutoff).execute()
+
+    def start(self):
+        if self.backend == "local":
+            return
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(CLAIM_PRUNE_SECONDS)
+            try:
+                await asyncio.to_thread(self.prune)
+            except Exception as e:
+                print(f"Error pruning message claims: {e}")
+
+
+message_claims = MessageClaims()
@@ -0,0 +1,242 @@
+import time
+import asyncio
+import itertools
+import discord
+
+# Lower runs first: people waiting on the bot before admin-channel noise
+PRIORITY_DM = 0
+PRIORITY_REPLY = 1
+PRIORITY_REACTION = 2
+PRIORITY_ALERT = 3
+
+# Proactive limits, kept under Discord's (50 requests/s global, ~5 messages per 5s per channel)
+# so bursts are smoothed here instead of turning into 429s and Cloudflare bans
+GLOBAL_RATE_PER_SECOND = 40
+ROUTE_LIMITS = {
+    # route kind -> (requests, per seconds)
+    "send": (5, 5.0),
+    "dm": (5, 5.0),
+    "edit": (5, 5.0),
+    "react": (4, 1.0),
+}
+MAX_IN_FLIGHT = 10
+MAX_RETRIES = 3
+# Streamed messages are edited at most this often (the edit route allows 5 per 5s)
+STREAM_EDIT_SECONDS = 1.0
+# Discord's message length limit
+MAX_MESSAGE_LENGTH = 2000
+
+
+class _Bucket:
+    def __init__(self, count, per_seconds):
+        self.capacity = count
+        self.rate = count / per_seconds
+        self.tokens = float(count)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds):
+        # Discord said 429: nothing on this route until retry_after has passed, then one retry
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = min(self.tokens, 1.0)
+
+
+class _Op:
+    def __init__(self, priority, seq, route, factory, coalesce_key):
+        self.priority = priority
+        self.seq = seq
+        self.route = route
+        self.factory = factory
+        self.coalesce_key = coalesce_key
+        self.future = asyncio.get_running_loop().create_future()
+        self.attempts = 0
+
+
+class DiscordOutbox:
+    """
+    Central queue for outbound Discord calls (messages, DMs, replies, edits, reactions).
+    Calls run in priority order as their route (channel/DM and kind) and the global budget
+    allow, pending edits of the same message collapse into the latest one, and a 429 pauses
+    just the affected route (or everything, if it was the global limit) before retrying.
+    discord.py's own bucket handling still applies underneath; this keeps us from reaching it.
+    """
+
+    def __init__(self):
+        self.pending = []
+        self.coalesced = {}
+        self.buckets = {}
+        self.global_bucket = _Bucket(GLOBAL_RATE_PER_SECOND, 1.0)
+        self.counter = itertools.count()
+        self.in_flight = 0
+        self.wakeup = None
+        self.task = None
+
+    def _bucket(self, route):
+        bucket = self.buckets.get(route)
+        if bucket is None:
+            bucket = self.buckets[route] = _Bucket(*ROUTE_LIMITS[route[0]])
+        return bucket
+
+    def _submit(self, priority, route, factory, coalesce_key=None):
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self._run())
+
+        if coalesce_key is not None and coalesce_key in self.coalesced:
+            # Not sent yet: the newer content replaces it, both callers get the one result
+            op = self.coalesced[coalesce_key]
+            op.factory = factory
+            op.priority = min(op.priority, priority)
+            return op.future
+
+        op = _Op(priority, next(self.counter), route, factory, coalesce_key)
+        self.pending.append(op)
+        if coalesce_key is not None:
+            self.coalesced[coalesce_key] = op
+        self.wakeup.set()
+        return op.future
+
+    async def _run(self):
+        while True:
+            self.wakeup.clear()
+            delay = None
+            if self.pending and self.in_flight < MAX_IN_FLIGHT:
+                now = time.monotonic()
+                global_wait = self.global_bucket.wait_time(now)
+                chosen = None
+                if global_wait <= 0:
+                    # Highest priority op whose route has room; a throttled channel doesn't block the rest
+                    for op in sorted(self.pending, key=lambda o: (o.priority, o.seq)):
+                        route_wait = self._bucket(op.route).wait_time(now)
+                        if route_wait <= 0:
+                            chosen = op
+                            break
+                        delay = route_wait if delay is None else min(delay, route_wait)
+                else:
+                    delay = global_wait
+
+                if chosen:
+                    self.pending.remove(chosen)
+                    if chosen.coalesce_key is not None:
+                        self.coalesced.pop(chosen.coalesce_key, None)
+                    self.global_bucket.take()
+                    self._bucket(chosen.route).take()
+                    self.in_flight += 1
+                    asyncio.create_task(self._execute(chosen))
+                    continue
+
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _execute(self, op):
+        try:
+            result = await op.factory()
+        except discord.HTTPException as e:
+            if e.status == 429 and op.attempts < MAX_RETRIES:
+                op.attempts += 1
+                retry_after = getattr(e, "retry_after", None) or 1.0
+                is_global = "global" in str(getattr(e, "text", "")).lower()
+                print(f"OUTBOX: 429 on {op.route} ({'global' if is_global else 'route'}), retrying in {retry_after:.1f}s", flush=True)
+                (self.global_bucket if is_global else self._bucket(op.route)).block(retry_after)
+                self.pending.append(op)
+            elif not op.future.done():
+                op.future.set_exception(e)
+        except Exception as e:
+            if not op.future.done():
+                op.future.set_exception(e)
+        else:
+            if not op.future.done():
+                op.future.set_result(result)
+        finally:
+            self.in_flight -= 1
+            self.wakeup.set()
+
+    def queued(self):
+        return len(self.pending)
+
+    # --- Public API: each returns an awaitable with the discord.py result (or its exception) ---
+
+    def send(self, destination, content=None, priority=None, **kwargs):
+        """Sends to a channel, or DMs a user/member (DMs default to the highest priority)."""
+        if isinstance(destination, (discord.User, discord.Member, discord.DMChannel)):
+            route = ("dm", destination.id)
+            priority = PRIORITY_DM if priority is None else priority
+        else:
+            route = ("send", destination.id)
+            priority = PRIORITY_REPLY if priority is None else priority
+        return self._submit(priority, route, lambda: destination.send(content, **kwargs))
+
+    def reply(self, message, content, priority=PRIORITY_REPLY, **kwargs):
+        return self._submit(priority, ("send", message.channel.id), lambda: message.reply(content, **kwargs))
+
+    def edit(self, message, content, priority=PRIORITY_ALERT):
+        """Edits a message; edits still queued for the same message are replaced by this one."""
+        return self._submit(priority, ("edit", message.channel.id), lambda: message.edit(content=content),
+                            coalesce_key=("edit", message.id))
+
+    def react(self, message, emoji, priority=PRIORITY_REACTION):
+        return self._submit(priority, ("react", message.channel.id), lambda: message.add_reaction(emoji))
+
+    async def send_streamed(self, destination, chunks, render=None, message=None):
+        """
+        Posts text as it streams in: the first non-empty render(text so far) is sent to
+        destination (or edited into `message`, if given), later ones are edited in at most every
+        STREAM_EDIT_SECONDS, and the complete text is edited in at the end. A non-string chunk
+        (e.g. a parsed result at the end of the stream) is not rendered but returned as `result`.
+        Returns (message, full text, result); errors of the first send are raised.
+        """
+        render = render or (lambda text: text.strip())
+        text = ""
+        result = None
+        shown = ""
+        last_edit = 0.0
+        try:
+            async for chunk in chunks:
+                if not isinstance(chunk, str):
+                    result = chunk
+                    continue
+                text += chunk
+                content = render(text)[:MAX_MESSAGE_LENGTH]
+                if not content or content == shown:
+                    continue
+                if message is None:
+                    message = await self.send(destination, content)
+                    shown, last_edit = content, time.monotonic()
+                elif time.monotonic() - last_edit >= STREAM_EDIT_SECONDS:
+                    self._edit_in_background(message, content)
+                    shown, last_edit = content, time.monotonic()
+        finally:
+            # On an early exit (e.g. the DM is refused) this stops the producer, so it doesn't
+            # keep reading the LLM stream on an executor thread nobody is listening to
+            if hasattr(chunks, "aclose"):
+                await chunks.aclose()
+
+        content = render(text)[:MAX_MESSAGE_LENGTH]
+        if message is not None and content and content != shown:
+            await self.edit(message, content)
+        return message, text, result
+
+    def _edit_in_background(self, message, content):
+        # Streaming keeps reading tokens meanwhile; a failed intermediate edit is just logged
+        def log_failure(future):
+            if not future.cancelled() and future.exception():
+                print(f"OUTBOX: Streamed edit failed: {future.exception()}", flush=True)
+        self.edit(message, content, priority=PRIORITY_DM).add_done_callback(log_failure)
+
+
+outbox = DiscordOutbox()
@@ -0,0 +1,177 @@
+import time
+import asyncio
+from collections import deque
+from services.fair_queue import FairQueue
+
+# Latency samples kept per stage for the percentiles in stats()
+LATENCY_SAMPLES = 500
+# Seconds between PIPELINE: stats lines (only printed when something moved)
+STATS_LOG_SECONDS = 60
+
+
+def _percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+class Stage:
+    """
+    One pipeline stage: a bounded queue drained by `workers` tasks running `handler`.
+    The handler returns the item to pass to the next stage, or None to stop there.
+    With `key` the queue is fair across tenants (key(item), weighted by weight(item))
+    instead of first-come-first-served; `priority` then orders each tenant's items.
+    With batch_size > 1 a worker takes up to batch_size items, waiting at most batch_seconds
+    for more after the first, and the handler gets the list and returns one result per item.
+    """
+
+    def __init__(self, name, handler, workers=1, maxsize=100, key=None, weight=None, priority=None,
+                 batch_size=1, batch_seconds=0.0):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.batch_size = max(1, batch_size)
+        self.batch_seconds = batch_seconds
+        if key:
+            # Queue entries are (enqueued_at, item)
+            self.queue = FairQueue(maxsize=maxsize, key=lambda entry: key(entry[1]),
+                                   weight=(lambda entry: weight(entry[1])) if weight else None,
+                                   priority=(lambda entry: priority(entry[1])) if priority else None)
+        else:
+            self.queue = asyncio.Queue(maxsize=maxsize)
+        self.next = None
+        self.on_done = None
+        self.tasks = []
+        self.busy = 0
+        self.processed = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.waits = deque(maxlen=LATENCY_SAMPLES)
+
+    def start(self):
+        self.tasks = [t for t in self.tasks if not t.done()]
+        for _ in range(len(self.tasks), self.workers):
+            self.tasks.append(asyncio.create_task(self._worker()))
+
+    async def _next_batch(self):
+        entries = [await self.queue.get()]
+        deadline = time.monotonic() + self.batch_seconds
+        while len(entries) < self.batch_size:
+            if not self.queue.empty():
+                entries.append(self.queue.get_nowait())
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                entries.append(await asyncio.wait_for(self.queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+        return entries
+
+    async def _worker(self):
+        while True:
+            if self.batch_size > 1:
+                entries = await self._next_batch()
+            else:
+                entries = [await self.queue.get()]
+            items = [item for _, item in entries]
+            started = time.monotonic()
+            self.waits.extend(started - enqueued_at for enqueued_at, _ in entries)
+            self.busy += 1
+            try:
+                if self.batch_size > 1:
+                    results = await self.handler(items)
+                else:
+                    results = [await self.handler(items[0])]
+            except Exception as e:
+                self.failed += len(items)
+                print(f"PIPELINE: {self.name} failed: {e}", flush=True)
+                results = [None] * len(items)
+            finally:
+                self.busy -= 1
+                self.latencies.append(time.monotonic() - started)
+                self.processed += len(items)
+                for _ in items:
+                    self.queue.task_done()
+            for item, result in zip(items, results):
+                if result is not None and self.next:
+                    # Blocks while the next stage is full, so a slow stage backs up the ones before it
+                    await self.next.queue.put((time.monotonic(), result))
+                elif self.on_done:
+                    # Finished, dropped or failed: the item has left the pipeline
+                    self.on_done(item)
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "busy": self.busy,
+            "workers": self.workers,
+            "processed": self.processed,
+            "failed": self.failed,
+            "p50_ms": round(_percentile(self.latencies, 0.5) * 1000),
+            "p95_ms": round(_percentile(self.latencies, 0.95) * 1000),
+            "wait_p95_ms": round(_percentile(self.waits, 0.95) * 1000),
+        }
+
+
+class Pipeline:
+    """
+    Stages connected by bounded asyncio queues. submit() waits up to `timeout` for room
+    in the first stage and sheds the item after that, so a backlog can't grow without bound.
+    on_done(item) is called whenever an item leaves the pipeline (completed, dropped or failed).
+    """
+
+    def __init__(self, name, stages, on_done=None):
+        self.name = name
+        self.stages = stages
+        for stage, following in zip(stages, stages[1:]):
+            stage.next = following
+        for stage in stages:
+            stage.on_done = on_done
+        self.rejected = 0
+        self.stats_task = None
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+        if self.stats_task is None or self.stats_task.done():
+            self.stats_task = asyncio.create_task(self._log_stats())
+
+    def stop(self):
+        for task in [t for stage in self.stages for t in stage.tasks] + [self.stats_task]:
+            if task:
+                task.cancel()
+
+    async def submit(self, item, timeout=5.0, stage=None):
+        """Queues item at the first stage, or at the named stage to skip the ones before it."""
+        self.start()
+        target = next(s for s in self.stages if s.name == stage) if stage else self.stages[0]
+        try:
+            await asyncio.wait_for(target.queue.put((time.monotonic(), item)), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            print(f"PIPELINE: {self.name} full, dropped an item after {timeout}s", flush=True)
+            return False
+
+    def stats(self):
+        return {"rejected": self.rejected, "stages": {stage.name: stage.stats() for stage in self.stages}}
+
+    def format_stats(self):
+        parts = [
+            f"{name} q={s['queued']} busy={s['busy']}/{s['workers']} done={s['processed']} "
+            f"failed={s['failed']} p50={s['p50_ms']}ms p95={s['p95_ms']}ms wait_p95={s['wait_p95_ms']}ms"
+            for name, s in self.stats()["stages"].items()
+        ]
+        return f"PIPELINE {self.name}: " + " | ".join(parts) + f" | rejected={self.rejected}"
+
+    async def _log_stats(self):
+        last = None
+        while True:
+            await asyncio.sleep(STATS_LOG_SECONDS)
+            snapshot = self.stats()
+            if snapshot != last:
+                print(self.format_stats(), flush=True)
+            last = snapshot
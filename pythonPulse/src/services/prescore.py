@@ -0,0 +1,77 @@
+import re
+from collections import OrderedDict
+
+# Points per matched signal; the total is clamped to 0-10 like analyze_urgency's score
+CRITICAL_TERMS = {
+    r"\b(outage|is down|went down|are down|site down|server down|offline)\b": 3,
+    r"\b(payments?|billing|charged|refund|checkout|invoice)\b": 3,
+    r"\b(data loss|lost (my|all|our) data|deleted|corrupt(ed)?)\b": 3,
+    r"\b(security|hacked|breach|leak(ed)?|compromised|vulnerabilit(y|ies))\b": 3,
+    r"\b(can'?t|cannot|unable to) (log ?in|sign ?in|access|connect|pay)\b": 2,
+    r"\b(everyone|all (users|of us|customers)|nobody can|no one can)\b": 2,
+    r"\b(crash(es|ed|ing)?|broken|not working|doesn'?t work|fail(s|ed|ing)?|error|500|502|503)\b": 1,
+    r"\b(urgent|asap|emergency|critical|production|prod)\b": 1,
+}
+CASUAL_TERMS = {
+    r"^(hi|hey|hello|thanks|thank you|ty|lol|ok|okay|gm|gn)\b": -2,
+    r"\b(how do i|how to|is there a way|where can i|question)\b": -1,
+}
+# Manual !report submissions: the fixed baseline score they've always had
+MANUAL_REPORT_SCORE = 7
+# Queue aging: a waiting item gains this many points per second, so low scores never starve
+AGING_POINTS_PER_SECOND = 1 / 30
+# Users whose recent triage scores are remembered
+USER_HISTORY_SIZE = 10000
+
+_CRITICAL = [(re.compile(p), w) for p, w in CRITICAL_TERMS.items()]
+_CASUAL = [(re.compile(p), w) for p, w in CASUAL_TERMS.items()]
+
+
+class PreScorer:
+    """
+    Cheap, LLM-free estimate (0-10) of how urgent a report is, used only to order the AI
+    queue: keyword and shape heuristics, plus the user's recent triage history.
+    """
+
+    def __init__(self):
+        # user id -> moving average of their analyze_urgency scores
+        self.history = OrderedDict()
+
+    def observe(self, user_id, score):
+        """Feeds back the LLM score of one of the user's messages."""
+        previous = self.history.pop(user_id, None)
+        self.history[user_id] = score if previous is None else 0.7 * previous + 0.3 * score
+        while len(self.history) > USER_HISTORY_SIZE:
+            self.history.popitem(last=False)
+
+    def score(self, content, user_id=None):
+        text = (content or "").lower()
+        points = 2.0
+        points += sum(w for pattern, w in _CRITICAL if pattern.search(text))
+        points += sum(w for pattern, w in _CASUAL if pattern.search(text))
+
+        letters = [c for c in content or "" if c.isalpha()]
+        if len(letters) >= 12 and sum(c.isupper() for c in letters) / len(letters) > 0.7:
+            points += 1  # SHOUTING
+        if (content or "").count("!") >= 2:
+            points += 1
+        if len(text.split()) < 4 and text.rstrip().endswith("?"):
+            points -= 1  # short question
+
+        history = self.history.get(user_id)
+        if history is not None:
+            # Users whose reports tend to be urgent get part of that credit up front
+            points += (history - 5) * 0.3
+        return max(0.0, min(10.0, points))
+
+
+def aged_priority(score, received_at):
+    """
+    Queue key for a score first seen at received_at (time.monotonic()). Every waiting item
+    ages at the same rate, so comparing score - rate * arrival is the same as comparing the
+    aged scores at any moment, and the key never has to be recomputed.
+    """
+    return score - AGING_POINTS_PER_SECOND * received_at
+
+
+prescorer = PreScorer()
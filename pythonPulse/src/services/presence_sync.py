@@ -0,0 +1,163 @@
+import asyncio
+from datetime import datetime, timezone
+from services.supabase_client import supabase
+
+# Seconds between flushes of buffered presence changes
+PRESENCE_FLUSH_SECONDS = 15
+# Max IDs per UPDATE ... WHERE discord_user_id IN (...) (keeps the PostgREST URL short)
+PRESENCE_UPDATE_CHUNK = 200
+# Known-user set maintenance: incremental refresh interval and full reload interval (seconds)
+KNOWN_USERS_REFRESH_SECONDS = 300
+KNOWN_USERS_RELOAD_SECONDS = 3600
+KNOWN_USERS_PAGE_SIZE = 1000
+
+
+class KnownUsers:
+    """
+    In-memory set of Discord user IDs linked to a ProjectPulse profile, so presence
+    events for everyone else are dropped without touching the database.
+    Stored as ints (Discord snowflakes) to keep the set compact.
+
+    Kept current by add() whenever the bot sees a link (guild owner, ticket reporter),
+    an incremental refresh of recently linked profiles, and a periodic full reload
+    that also forgets unlinked users.
+    """
+
+    def __init__(self):
+        self.ids = set()
+        self.loaded = False
+        self.last_refresh = None
+        self.task = None
+
+    def __contains__(self, discord_user_id):
+        # Until the first load finishes, let everything through rather than lose updates
+        if not self.loaded:
+            return True
+        try:
+            return int(discord_user_id) in self.ids
+        except (TypeError, ValueError):
+            return False
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, discord_user_id):
+        try:
+            self.ids.add(int(discord_user_id))
+        except (TypeError, ValueError):
+            pass
+
+    def _fetch(self, since=None):
+        ids = set()
+        start = 0
+        while True:
+            query = supabase.table("profiles").select("discord_user_id").not_.is_("discord_user_id", "null")
+            if since:
+                # Set by a trigger whenever discord_user_id changes (see schema.sql)
+                query = query.gte("discord_linked_at", since)
+            res = query.order("id").range(start, start + KNOWN_USERS_PAGE_SIZE - 1).execute()
+            rows = res.data or []
+            for row in rows:
+                try:
+                    ids.add(int(row["discord_user_id"]))
+                except (TypeError, ValueError):
+                    pass
+            if len(rows) < KNOWN_USERS_PAGE_SIZE:
+                return ids
+            start += KNOWN_USERS_PAGE_SIZE
+
+    def load(self):
+        """Full (blocking) reload of linked Discord IDs."""
+        started = datetime.now(timezone.utc).isoformat()
+        self.ids = self._fetch()
+        self.loaded = True
+        self.last_refresh = started
+        print(f"Loaded {len(self.ids)} linked Discord users for presence sync")
+
+    def refresh(self):
+        """Adds users linked since the last refresh (blocking)."""
+        started = datetime.now(timezone.utc).isoformat()
+        self.ids |= self._fetch(since=self.last_refresh)
+        self.last_refresh = started
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        since_reload = 0
+        while True:
+            try:
+                if not self.loaded or since_reload >= KNOWN_USERS_RELOAD_SECONDS:
+                    await asyncio.to_thread(self.load)
+                    since_reload = 0
+                else:
+                    await asyncio.to_thread(self.refresh)
+            except Exception as e:
+                print(f"Error refreshing known Discord users: {e}")
+            await asyncio.sleep(KNOWN_USERS_REFRESH_SECONDS)
+            since_reload += KNOWN_USERS_REFRESH_SECONDS
+
+
+class PresenceBuffer:
+    """
+    Collects presence changes into a latest-state-per-user map and flushes them periodically.
+    Rapid online/idle/offline flapping between flushes collapses into the final status,
+    and each flush writes one UPDATE per distinct status instead of one per event.
+    """
+
+    def __init__(self, flush_seconds=PRESENCE_FLUSH_SECONDS):
+        self.flush_seconds = flush_seconds
+        self.pending = {}
+        # Last status written per user, so repeats (activity changes, one event per shared guild) are skipped
+        self.written = {}
+        self.task = None
+
+    def record(self, discord_user_id, status):
+        user_id = str(discord_user_id)
+        if user_id not in self.pending and self.written.get(user_id) == status:
+            return
+        self.pending[user_id] = status
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            await self.flush()
+
+    async def flush(self):
+        if not self.pending:
+            return 0
+        # Swap the map first so events arriving mid-flush land in the next round
+        batch, self.pending = self.pending, {}
+
+        by_status = {}
+        for user_id, status in batch.items():
+            by_status.setdefault(status, []).append(user_id)
+
+        try:
+            await asyncio.to_thread(self._write, by_status)
+        except Exception as e:
+            print(f"Error syncing presence: {e}")
+            # Put failed entries back unless a newer status arrived meanwhile
+            for user_id, status in batch.items():
+                self.pending.setdefault(user_id, status)
+            return 0
+        self.written.update(batch)
+        return len(batch)
+
+    def _write(self, by_status):
+        # profiles is keyed by the auth UUID, not discord_user_id, so a bulk upsert would
+        # insert rows for unknown users; grouped UPDATEs touch existing profiles only.
+        for status, user_ids in by_status.items():
+            for i in range(0, len(user_ids), PRESENCE_UPDATE_CHUNK):
+                supabase.table("profiles").update({
+                    "discord_status": status
+                }).in_("discord_user_id", user_ids[i:i + PRESENCE_UPDATE_CHUNK]).execute()
+
+
+known_users = KnownUsers()
+presence_buffer = PresenceBuffer()
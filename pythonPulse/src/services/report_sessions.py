@@ -0,0 +1,111 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from config import MESSAGE_CLAIMS
+
+# A report still waiting for the user's DM follow-up after this long is forgotten
+SESSION_TTL_HOURS = 24
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+class ReportSessions:
+    """
+    Reports waiting for the user's follow-up DM, keyed by Discord user id.
+
+    The report is handled by the process running the guild's shard, but DMs only reach
+    the process running shard 0, so with several bot processes the session has to live
+    in the report_sessions table. With MESSAGE_CLAIMS=local, or while Supabase is
+    unreachable, the in-process copy is used on its own.
+    """
+
+    def __init__(self, backend=MESSAGE_CLAIMS):
+        self.backend = backend
+        self.local = {}
+
+    def _expired(self, session):
+        created = session.get("created_at")
+        if isinstance(created, str):
+            created = datetime.fromisoformat(created.replace("Z", "+00:00"))
+        return created is not None and _now() - created > timedelta(hours=SESSION_TTL_HOURS)
+
+    def _from_row(self, row):
+        return {
+            "content": row.get("content"),
+            "score": row.get("score"),
+            "channel_id": int(row["channel_id"]) if row.get("channel_id") else None,
+            "guild_id": int(row["guild_id"]) if row.get("guild_id") else None,
+            "ticket_id": row.get("ticket_id"),
+            "created_at": row.get("created_at"),
+        }
+
+    def put_blocking(self, user_id, session):
+        session = {**session, "created_at": _now()}
+        self.local[user_id] = session
+        if self.backend == "local":
+            return
+        try:
+            from services.supabase_client import supabase
+            supabase.table("report_sessions").upsert({
+                "discord_user_id": str(user_id),
+                "ticket_id": None if session.get("ticket_id") is None else str(session["ticket_id"]),
+                "guild_id": None if session.get("guild_id") is None else str(session["guild_id"]),
+                "channel_id": None if session.get("channel_id") is None else str(session["channel_id"]),
+                "content": session.get("content"),
+                "score": session.get("score"),
+                "created_at": session["created_at"].isoformat()
+            }, on_conflict="discord_user_id").execute()
+        except Exception as e:
+            print(f"Warning: Failed to store report session for {user_id}, keeping it locally: {e}")
+
+    def pop_blocking(self, user_id):
+        """Removes and returns the user's session, or None."""
+        session = self.local.pop(user_id, None)
+        if self.backend != "local":
+            try:
+                from services.supabase_client import supabase
+                res = supabase.table("report_sessions").delete().eq("discord_user_id", str(user_id)).execute()
+                if res.data and session is None:
+                    session = self._from_row(res.data[0])
+            except Exception as e:
+                print(f"Warning: Failed to load report session for {user_id}: {e}")
+        if session is None or self._expired(session):
+            return None
+        return session
+
+    def active_blocking(self, user_id):
+        """True if the user has a report waiting for its follow-up (in any process)."""
+        session = self.local.get(user_id)
+        if session is not None and not self._expired(session):
+            return True
+        if self.backend == "local":
+            return False
+        try:
+            from services.supabase_client import supabase
+            cutoff = (_now() - timedelta(hours=SESSION_TTL_HOURS)).isoformat()
+            res = supabase.table("report_sessions")\
+                .select("discord_user_id")\
+                .eq("discord_user_id", str(user_id))\
+                .gte("created_at", cutoff)\
+                .limit(1)\
+                .execute()
+            return bool(res.data)
+        except Exception as e:
+            print(f"Warning: Failed to check report session for {user_id}: {e}")
+            return False
+
+    async def put(self, user_id, session):
+        await asyncio.to_thread(self.put_blocking, user_id, session)
+
+    async def pop(self, user_id):
+        return await asyncio.to_thread(self.pop_blocking, user_id)
+
+    async def active(self, user_id):
+        return await asyncio.to_thread(self.active_blocking, user_id)
+
+    async def discard(self, user_id):
+        await asyncio.to_thread(self.pop_blocking, user_id)
+
+
+report_sessions = ReportSessions()
@@ -0,0 +1,152 @@
+import time
+import asyncio
+from collections import deque, Counter
+from datetime import datetime, timezone
+from services.outbox import outbox, PRIORITY_ALERT
+
+# A guild enters incident mode at this many urgent reports within the window
+STORM_THRESHOLD = 5
+STORM_WINDOW_SECONDS = 300
+# The aggregated alert is edited at most this often
+STORM_EDIT_SECONDS = 15
+# Incident mode ends after this long without a new urgent report
+STORM_QUIET_SECONDS = 600
+# Keep the alert under Discord's 2000 character limit
+STORM_MAX_LISTED_USERS = 25
+STORM_MAX_LISTED_REASONS = 5
+
+
+class Incident:
+    def __init__(self, started_at):
+        self.started_at = started_at
+        self.last_report = time.monotonic()
+        self.count = 0
+        self.max_score = 0
+        self.users = {}  # user id -> mention, in order of first report
+        self.reasons = Counter()
+        self.channel = None
+        self.message = None
+        self.dirty = True
+        self.task = None
+
+    def add(self, user_id, mention, score, reason):
+        self.count += 1
+        self.max_score = max(self.max_score, score)
+        self.users.setdefault(user_id, mention)
+        self.reasons[(reason or "No reason provided").strip()[:150]] += 1
+        self.last_report = time.monotonic()
+        self.dirty = True
+
+
+class ReportStormDetector:
+    """
+    Per-guild sliding-window counter over urgent reports. Below STORM_THRESHOLD reports
+    per STORM_WINDOW_SECONDS every report gets its own admin alert; past it the guild
+    switches to incident mode, where a single alert message is sent and then edited
+    (at most every STORM_EDIT_SECONDS) with the running count, affected users and reasons,
+    until reports stop for STORM_QUIET_SECONDS.
+    """
+
+    def __init__(self, threshold=STORM_THRESHOLD, window_seconds=STORM_WINDOW_SECONDS,
+                 edit_seconds=STORM_EDIT_SECONDS, quiet_seconds=STORM_QUIET_SECONDS):
+        self.threshold = threshold
+        self.window_seconds = window_seconds
+        self.edit_seconds = edit_seconds
+        self.quiet_seconds = quiet_seconds
+        # guild_id -> deque of (monotonic time, user id, mention, score, reason)
+        self.windows = {}
+        self.incidents = {}
+        self.last_sweep = time.monotonic()
+
+    def record(self, guild_id, user_id, mention, score, reason):
+        """Counts an urgent report. Returns True if the guild is in incident mode (don't alert individually)."""
+        now = time.monotonic()
+        window = self.windows.setdefault(guild_id, deque())
+        window.append((now, user_id, mention, score, reason))
+        while window and now - window[0][0] > self.window_seconds:
+            window.popleft()
+        if now - self.last_sweep >= self.window_seconds:
+            self._sweep(now)
+
+        incident = self.incidents.get(guild_id)
+        if incident:
+            incident.add(user_id, mention, score, reason)
+            return True
+
+        if len(window) < self.threshold:
+            return False
+
+        print(f"STORM: Guild {guild_id} entered incident mode ({len(window)} urgent reports in {self.window_seconds}s)")
+        incident = self.incidents[guild_id] = Incident(datetime.now(timezone.utc))
+        # The reports that tipped it over are part of the incident (they already had their own alerts)
+        for _, uid, m, s, r in window:
+            incident.add(uid, m, s, r)
+        return True
+
+    def _sweep(self, now):
+        """Expires old reports in every guild's window and forgets guilds with none left."""
+        self.last_sweep = now
+        for guild_id in list(self.windows):
+            window = self.windows[guild_id]
+            while window and now - window[0][0] > self.window_seconds:
+                window.popleft()
+            if not window:
+                del self.windows[guild_id]
+
+    async def alert(self, guild_id, channel):
+        """Makes sure the guild's aggregated alert gets sent/updated in channel."""
+        incident = self.incidents.get(guild_id)
+        if not incident:
+            return
+        incident.channel = incident.channel or channel
+        if incident.task is None or incident.task.done():
+            incident.task = asyncio.create_task(self._run(guild_id, incident))
+
+    def render(self, incident, final=False):
+        users = list(incident.users.values())
+        listed = ", ".join(users[:STORM_MAX_LISTED_USERS])
+        if len(users) > STORM_MAX_LISTED_USERS:
+            listed += f" and {len(users) - STORM_MAX_LISTED_USERS} more"
+        reasons = "\n".join(
+            f"- {reason}" + (f" (x{n})" if n > 1 else "")
+            for reason, n in incident.reasons.most_common(STORM_MAX_LISTED_REASONS)
+        )
+        started = incident.started_at.strftime("%H:%M UTC")
+        updated = datetime.now(timezone.utc).strftime("%H:%M:%S UTC")
+        header = "Incident over" if final else "Incident mode"
+        footer = (f"_No urgent reports for {self.quiet_seconds // 60} minutes, individual alerts are back on._" if final
+                  else f"_Updated {updated}. Individual alerts are paused until reports slow down._")
+        return (
+            f"🚨 **{header}**: {incident.count} urgent reports since {started}\n"
+            f"**Highest level:** {incident.max_score}/10\n"
+            f"**Affected users ({len(users)}):** {listed}\n"
+            f"**Top reasons:**\n{reasons}\n"
+            f"{footer}"
+        )[:2000]
+
+    async def _flush(self, incident, final=False):
+        incident.dirty = False
+        content = self.render(incident, final)
+        try:
+            if incident.message is None:
+                incident.message = await outbox.send(incident.channel, content, priority=PRIORITY_ALERT)
+            else:
+                await outbox.edit(incident.message, content)
+        except Exception as e:
+            print(f"Error updating incident alert: {e}")
+            incident.dirty = True
+
+    async def _run(self, guild_id, incident):
+        while True:
+            if incident.dirty:
+                await self._flush(incident)
+            await asyncio.sleep(self.edit_seconds)
+            if time.monotonic() - incident.last_report >= self.quiet_seconds:
+                break
+        self.incidents.pop(guild_id, None)
+        self._sweep(time.monotonic())
+        print(f"STORM: Guild {guild_id} left incident mode after {incident.count} reports")
+        await self._flush(incident, final=True)
+
+
+report_storm = ReportStormDetector()
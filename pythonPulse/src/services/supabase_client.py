@@ -47,6 +47,15 @@ def link_message_to_ticket(message_id, ticket_id):
         print(f"Error linking message {message_id} to ticket {ticket_id}: {e}")
         return False
 
+def record_duplicate_report(ticket_id):
+    """Bumps a ticket's report_count by one (atomically, in Postgres). Returns the new count or None."""
+    try:
+        response = supabase.rpc("increment_ticket_report_count", {"p_ticket_id": ticket_id}).execute()
+        return response.data
+    except Exception as e:
+        print(f"Error recording duplicate report for ticket {ticket_id}: {e}")
+        return None
+
 def get_messages_last_24h(guild_id: int = None):
     """Fetches messages from the last 24 hours, optionally filtered by guild."""
     try:
@@ -61,8 +70,42 @@ def get_messages_last_24h(guild_id: int = None):
         print(f"Error fetching messages: {e}")
         return []
 
+def get_latest_message_id(guild_id: int):
+    """ID of the newest logged message in a guild (None if there are none), a cheap "anything new?" check."""
+    try:
+        response = supabase.table("messages")\
+            .select("id")\
+            .eq("discord_guild_id", str(guild_id))\
+            .order("id", desc=True)\
+            .limit(1)\
+            .execute()
+        return response.data[0]["id"] if response.data else None
+    except Exception as e:
+        print(f"Error fetching latest message id: {e}")
+        return None
+
+def get_messages_since(guild_id: int, after_id: int):
+    """Messages in a guild logged after the given message ID, newest first."""
+    try:
+        response = supabase.table("messages")\
+            .select("*")\
+            .eq("discord_guild_id", str(guild_id))\
+            .gt("id", after_id)\
+            .order("created_at", desc=True)\
+            .limit(200)\
+            .execute()
+        return response.data
+    except Exception as e:
+        print(f"Error fetching messages: {e}")
+        return []
+
 def check_guild_subscription(guild_id: int):
     """Checks if a Discord guild (by its ID) has an active subscription."""
+    is_active, message, _ = get_guild_plan(guild_id)
+    return is_active, message
+
+def get_guild_plan(guild_id: int):
+    """Like check_guild_subscription, plus the plan tier: (is_active, message, tier)."""
     try:
         print(f"Checking subscription for guild_id: {guild_id} (type: {type(guild_id)})")
         
@@ -74,7 +117,7 @@ def check_guild_subscription(guild_id: int):
         
         if not response.data:
             print(f"No profile found with discord_guild_id={guild_id}")
-            return False, "This Discord server is not linked to an active ProjectPulse account. Use /link in the dashboard to connect."
+            return False, "This Discord server is not linked to an active ProjectPulse account. Use /link in the dashboard to connect.", "free"
         
         profile = response.data[0]
         tier = profile.get("subscription_tier", "free").lower()
@@ -85,9 +128,9 @@ def check_guild_subscription(guild_id: int):
         print(f"   Status: {status}")
         
         if tier in ["pro", "enterprise"]:
-            return True, "Active"
+            return True, "Active", tier
         
-        return False, "Your ProjectPulse plan (Free) does not include Daily Pulse summaries. Please upgrade to Pro."
+        return False, "Your ProjectPulse plan (Free) does not include Daily Pulse summaries. Please upgrade to Pro.", tier
     except Exception as e:
         print(f"Error checking subscription: {e}")
-        return False, f"Error verifying subscription status: {e}"
+        return False, f"Error verifying subscription status: {e}", "free"
@@ -8,6 +8,7 @@ from config import (
     JIRA_URL, JIRA_EMAIL, JIRA_API_TOKEN, JIRA_PROJECT_KEY
 )
 from services.supabase_client import supabase
+from services.presence_sync import known_users
 
 class TicketService:
     def create_ticket(self, report_data):
@@ -44,6 +45,7 @@ class SupabaseTicketService(TicketService):
                 
                 if profile_result.data and len(profile_result.data) > 0:
                     supabase_uuid = profile_result.data[0].get("id")
+                    known_users.add(discord_id)
                     print(f"Found Supabase UUID for Discord user {discord_id}: {supabase_uuid}")
                     
                     # 2. Find Team (Lookup memberships)
@@ -0,0 +1,32 @@
+import asyncio
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls: while a call for a key is in flight,
+    later callers with the same key wait on it and get the same result (or exception)
+    instead of hitting Stripe/Supabase again.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+
+    def in_flight(self, key):
+        return key in self._inflight
+
+    async def do(self, key, fn, *args, **kwargs):
+        """Runs the blocking fn(*args, **kwargs) in a worker thread, unless the same key is already running."""
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(asyncio.to_thread(fn, *args, **kwargs))
+            self._inflight[key] = future
+            future.add_done_callback(lambda f: self._forget(key, f))
+        # Shield so one caller disconnecting doesn't cancel the call for everyone else
+        return await asyncio.shield(future)
+
+    def _forget(self, key, future):
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        # Mark the exception as retrieved in case every waiter went away
+        if not future.cancelled():
+            future.exception()
@@ -0,0 +1,99 @@
+import stripe
+from datetime import datetime, timezone
+
+# Single-row table holding the Stripe event catch-up has replayed up to (see schema.sql)
+CURSOR_TABLE = "stripe_event_cursor"
+CURSOR_ROW_ID = "webhook"
+# Events the live webhook has handled, so catch-up doesn't apply them a second time
+PROCESSED_TABLE = "stripe_processed_events"
+
+
+def load_cursor(supabase):
+    """Returns {'event_id', 'event_created'} for the last processed event, or None if never recorded."""
+    res = supabase.table(CURSOR_TABLE).select("event_id, event_created").eq("id", CURSOR_ROW_ID).execute()
+    return res.data[0] if res.data else None
+
+
+def save_cursor(supabase, event_id, event_created):
+    """
+    Moves the cursor forward. The "older than" check is part of the UPDATE, so concurrent
+    writers (several workers or instances) can never move it backwards.
+    """
+    row = {"event_id": event_id, "event_created": event_created, "updated_at": "now()"}
+    res = supabase.table(CURSOR_TABLE).update(row)\
+        .eq("id", CURSOR_ROW_ID)\
+        .lt("event_created", event_created)\
+        .execute()
+    if not res.data:
+        # No row yet (first run), or the cursor is already at/after this event
+        supabase.table(CURSOR_TABLE).upsert(
+            {"id": CURSOR_ROW_ID, **row}, on_conflict="id", ignore_duplicates=True
+        ).execute()
+
+
+def record_processed_event(supabase, event):
+    """
+    Remembers that an event was handled (by the webhook or a catch-up replay). Never raises.
+
+    This doesn't move the cursor: deliveries arrive out of order and some fail, so only
+    catch-up, which replays every event in order, may say "everything before here is done".
+    """
+    try:
+        supabase.table(PROCESSED_TABLE).upsert({
+            "event_id": event['id'],
+            "event_created": event['created']
+        }, on_conflict="event_id", ignore_duplicates=True).execute()
+    except Exception as e:
+        print(f"Warning: Failed to record processed Stripe event: {e}", flush=True)
+
+
+def _processed_since(supabase, since):
+    res = supabase.table(PROCESSED_TABLE).select("event_id").gte("event_created", since).execute()
+    return {row["event_id"] for row in (res.data or [])}
+
+
+def catch_up_missed_events(supabase, handler, event_types):
+    """
+    Replays events created since the stored cursor through `handler(event, supabase)`, oldest first,
+    skipping the ones the webhook already handled, and moves the cursor over the contiguous run of
+    done events. On first run there is nothing to replay, so the cursor is just initialised to now.
+    """
+    cursor = load_cursor(supabase)
+    if not cursor:
+        now = int(datetime.now(timezone.utc).timestamp())
+        save_cursor(supabase, None, now)
+        print("STRIPE CATCH-UP: No cursor found, starting from now.", flush=True)
+        return 0
+
+    since = cursor["event_created"]
+    # Event.list returns newest first; collect the pages then apply in creation order.
+    # gte (not gt) keeps events sharing the cursor's second; the cursor event itself is skipped below.
+    events = stripe.Event.list(created={"gte": since}, types=event_types, limit=100)
+    missed = [e for e in events.auto_paging_iter() if e.id != cursor.get("event_id")]
+    missed.sort(key=lambda e: e.created)
+
+    if not missed:
+        print(f"STRIPE CATCH-UP: Up to date (cursor {cursor.get('event_id')}).", flush=True)
+        return 0
+
+    processed = _processed_since(supabase, since)
+    print(f"STRIPE CATCH-UP: {len(missed)} events since {since}, "
+          f"{len([e for e in missed if e.id not in processed])} not handled by the webhook yet...", flush=True)
+    replayed = 0
+    for event in missed:
+        if event.id not in processed:
+            try:
+                handler(event, supabase)
+            except Exception as e:
+                # Stop here so the cursor stays before the failed event and it is retried next time
+                print(f"STRIPE CATCH-UP ERROR on {event.id} ({event.type}): {e}", flush=True)
+                return replayed
+            replayed += 1
+            # The cursor is inclusive (created >= cursor): without this, other events sharing
+            # the cursor's second would be replayed again on every run
+            record_processed_event(supabase, {"id": event.id, "created": event.created})
+        save_cursor(supabase, event.id, event.created)
+
+    # Everything up to the cursor is covered by it now
+    supabase.table(PROCESSED_TABLE).delete().lt("event_created", missed[-1].created).execute()
+    return replayed
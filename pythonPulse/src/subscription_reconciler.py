@@ -0,0 +1,241 @@
+import os
+import sys
+import argparse
+from datetime import datetime, timezone
+
+import stripe
+from dotenv import load_dotenv
+
+load_dotenv()
+
+stripe.api_key = os.getenv("STRIPE_KEY")
+
+# Tiers that only exist because of a Stripe subscription.
+# A profile on one of these tiers with no subscription left in Stripe gets reset to free.
+PAID_TIERS = {"starter", "pro", "enterprise"}
+
+# Columns every upsert row carries (PostgREST bulk upserts need uniform keys)
+SYNCED_FIELDS = ("status", "subscription_tier", "trial_end", "stripe_customer_id")
+
+# Subscriptions in these states no longer grant a tier
+ENDED_STATUSES = {"canceled", "incomplete_expired"}
+
+UPSERT_BATCH_SIZE = 500
+PROFILE_PAGE_SIZE = 1000
+
+
+def subscription_priority(sub):
+    """Sort key so 'active' comes before 'trialing', then past_due/unpaid, then everything else."""
+    if sub.status == 'active': return 0
+    if sub.status == 'trialing': return 1
+    if sub.status in ['past_due', 'unpaid']: return 2
+    return 3
+
+
+def derive_profile_state(target_sub, plan_tier_id):
+    """Computes the profile fields to write for a profile whose best subscription is target_sub (may be None)."""
+    status = 'free'
+    trial_end = None
+
+    if target_sub and target_sub.status in ENDED_STATUSES:
+        # Same end state the customer.subscription.deleted webhook writes
+        return {'status': 'canceled', 'subscription_tier': 'free'}
+
+    if target_sub:
+        status = target_sub.status
+        # If canceling at period end, we treat it as 'cancelled' for the DB/UI
+        if target_sub.cancel_at_period_end:
+            status = 'cancelled'
+        if target_sub.trial_end:
+            trial_end = datetime.fromtimestamp(target_sub.trial_end, tz=timezone.utc).isoformat()
+
+    state = {'status': status}
+    if plan_tier_id:
+        state['subscription_tier'] = plan_tier_id
+        # Paid tier is shown as 'active' unless explicitly cancelled at period end
+        if status != 'cancelled':
+            state['status'] = 'active'
+    elif status == 'free':
+        state['subscription_tier'] = 'free'
+
+    if trial_end:
+        state['trial_end'] = trial_end
+    return state
+
+
+def _get_supabase():
+    from supabase import create_client
+    url = os.getenv("SUPABASE_URL")
+    key = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or os.getenv("SUPABASE_KEY")
+    return create_client(url, key)
+
+
+def fetch_product_tiers():
+    """Maps every Stripe product ID to its plan_tier_id metadata (one paged listing instead of a retrieve per sub)."""
+    tiers = {}
+    for product in stripe.Product.list(limit=100).auto_paging_iter():
+        tiers[product.id] = (product.metadata or {}).get('plan_tier_id')
+    return tiers
+
+
+def fetch_subscriptions():
+    """Pages through every Stripe subscription, with the customer expanded so we get emails for free."""
+    subs = stripe.Subscription.list(status='all', limit=100, expand=['data.customer'])
+    return list(subs.auto_paging_iter())
+
+
+def fetch_profiles(supabase):
+    """Loads all profiles in pages of PROFILE_PAGE_SIZE."""
+    profiles = []
+    start = 0
+    while True:
+        res = supabase.table('profiles')\
+            .select('id, email, status, subscription_tier, trial_end, stripe_customer_id')\
+            .order('id')\
+            .range(start, start + PROFILE_PAGE_SIZE - 1)\
+            .execute()
+        rows = res.data or []
+        profiles.extend(rows)
+        if len(rows) < PROFILE_PAGE_SIZE:
+            return profiles
+        start += PROFILE_PAGE_SIZE
+
+
+def _customer_field(sub, field):
+    customer = sub.customer
+    if isinstance(customer, str):
+        return customer if field == 'id' else None
+    return getattr(customer, field, None)
+
+
+def _sub_plan_tier(sub, product_tiers):
+    plan_tier_id = (sub.metadata or {}).get('plan_tier_id')
+    if plan_tier_id:
+        return plan_tier_id
+    try:
+        product = sub['items']['data'][0]['price']['product']
+    except (KeyError, IndexError, TypeError):
+        return None
+    product_id = product if isinstance(product, str) else getattr(product, 'id', None)
+    return product_tiers.get(product_id)
+
+
+def _normalize(field, value):
+    """Makes DB and Stripe values comparable (timestamps come back from Postgres with a different format)."""
+    if value is None:
+        return None
+    if field == 'trial_end':
+        try:
+            parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+        except ValueError:
+            return str(value)
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        return parsed.timestamp()
+    return str(value).lower() if field in ('status', 'subscription_tier') else str(value)
+
+
+def build_diff(profiles, subscriptions, product_tiers):
+    """Diffs Stripe against profiles in memory. Returns a list of {id, email, changes, row} for changed profiles only."""
+    by_id = {p['id']: p for p in profiles}
+    by_email = {}
+    for p in profiles:
+        if p.get('email'):
+            by_email.setdefault(p['email'].lower(), p)
+
+    # Group subscriptions per profile, same resolution order as /sync-subscription:
+    # email match first (handles re-signups with stale metadata), then metadata user_id.
+    subs_by_profile = {}
+    for sub in subscriptions:
+        email = _customer_field(sub, 'email')
+        profile = by_email.get(email.lower()) if email else None
+        if not profile:
+            profile = by_id.get((sub.metadata or {}).get('user_id'))
+        if profile:
+            subs_by_profile.setdefault(profile['id'], []).append(sub)
+
+    diff = []
+    for profile in profiles:
+        subs = subs_by_profile.get(profile['id'])
+        if subs:
+            target_sub = sorted(subs, key=subscription_priority)[0]
+            desired = derive_profile_state(target_sub, _sub_plan_tier(target_sub, product_tiers))
+            desired['stripe_customer_id'] = _customer_field(target_sub, 'id')
+        elif (profile.get('subscription_tier') or '').lower() in PAID_TIERS:
+            # Paid tier in the DB but nothing left in Stripe
+            desired = derive_profile_state(None, None)
+        else:
+            continue
+
+        changes = {}
+        for field, new_value in desired.items():
+            old_value = profile.get(field)
+            if _normalize(field, old_value) != _normalize(field, new_value):
+                changes[field] = (old_value, new_value)
+
+        if not changes:
+            continue
+
+        row = {'id': profile['id'], 'updated_at': 'now()'}
+        for field in SYNCED_FIELDS:
+            row[field] = desired.get(field, profile.get(field))
+        diff.append({'id': profile['id'], 'email': profile.get('email'), 'changes': changes, 'row': row})
+
+    return diff
+
+
+def apply_diff(supabase, diff):
+    """Writes changed rows as batched upserts. Returns the number of rows written."""
+    rows = [entry['row'] for entry in diff]
+    for i in range(0, len(rows), UPSERT_BATCH_SIZE):
+        supabase.table('profiles').upsert(rows[i:i + UPSERT_BATCH_SIZE]).execute()
+    return len(rows)
+
+
+def format_report(diff):
+    lines = []
+    for entry in diff:
+        lines.append(f"{entry['id']} ({entry.get('email') or 'no email'})")
+        for field, (old_value, new_value) in entry['changes'].items():
+            lines.append(f"    {field}: {old_value} -> {new_value}")
+    return "\n".join(lines)
+
+
+def reconcile_subscriptions(dry_run=False, supabase=None):
+    """Bulk reconciles every profile against Stripe. Only changed rows are written."""
+    print(f"RECONCILE: Starting subscription reconciliation (dry_run={dry_run})...", flush=True)
+    supabase = supabase or _get_supabase()
+
+    product_tiers = fetch_product_tiers()
+    subscriptions = fetch_subscriptions()
+    profiles = fetch_profiles(supabase)
+    diff = build_diff(profiles, subscriptions, product_tiers)
+
+    print(f"RECONCILE: {len(subscriptions)} subscriptions, {len(profiles)} profiles, {len(diff)} out of sync.", flush=True)
+    if diff:
+        print(format_report(diff), flush=True)
+
+    written = 0
+    if not dry_run and diff:
+        written = apply_diff(supabase, diff)
+        print(f"RECONCILE: Upserted {written} profiles.", flush=True)
+
+    return {
+        "subscriptions": len(subscriptions),
+        "profiles": len(profiles),
+        "changed": len(diff),
+        "written": written,
+        "dry_run": dry_run,
+        "diff": [{'id': e['id'], 'email': e['email'], 'changes': e['changes']} for e in diff],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reconcile Supabase profiles against Stripe subscriptions.")
+    parser.add_argument("--dry-run", action="store_true", help="Print the diff without writing anything")
+    args = parser.parse_args()
+
+    if not os.getenv("STRIPE_KEY"):
+        print("Error: STRIPE_KEY not found in .env")
+        sys.exit(1)
+    reconcile_subscriptions(dry_run=args.dry_run)